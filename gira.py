@@ -8,18 +8,34 @@ import json
 import re
 import urllib
 import click
+import fnmatch
+import functools
+import http.server
+import shutil
+import sqlite3
 import subprocess
+import tempfile
+import threading
+import time
 import requests
 import toml
+try:
+    import fcntl
+except ImportError:  # Windows: no metrics totals and no repo locks
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor
 from retrying import retry
 from git import Repo
 from git.exc import GitCommandError
 import git
-from jira import JIRA
+from jira import JIRA, JIRAError
+from jira.resources import Issue
 
 
 _conf = None
 _version = "2020-11-10"
+_http = requests.Session()  # pooled connections, shared by all threads
+_http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32))
 
 # JIRA ISSUE TRANSITION LIST
 # ID: 51, Name: Reopen, this seems wrong
@@ -50,24 +66,242 @@ def _open_url(url):
     subprocess.run([cmd, url])
 
 
+def _cache_dir():
+    d = os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.join(os.environ["HOME"], ".cache")), "gira"
+    )
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def _write_atomic(path, text, mode=0o644):
+    "Replaces path with text. The temp file is unique, so gira processes can race"
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".gira-")
+    try:
+        os.chmod(tmp, mode)
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class Metrics():
+    """Prometheus counters and histograms. flush() adds them to the totals of earlier
+    runs and writes a node-exporter textfile. serve() exposes them over HTTP"""
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}  # "name|labels" -> counter value or histogram buckets, count, sum
+        self.unsaved = {}
+
+    @staticmethod
+    def _key(name, labels):
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return name + "|" + ",".join(f'{k}="{esc(v)}"' for k, v in sorted(labels.items()))
+
+    @staticmethod
+    def _add(values, key, nums):
+        old = values.setdefault(key, [0] * len(nums))
+        for i, n in enumerate(nums):
+            old[i] += n
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.types[name] = "counter"
+            self._add(self.values, key, [value])
+            self._add(self.unsaved, key, [value])
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        nums = [int(seconds <= b) for b in Metrics.buckets] + [1, seconds]
+        with self.lock:
+            self.types[name] = "histogram"
+            self._add(self.values, key, nums)
+            self._add(self.unsaved, key, nums)
+
+    @staticmethod
+    def render(types, values):
+        lines = []
+        for name in sorted(types):
+            lines.append(f"# TYPE {name} {types[name]}")
+            for key in sorted(k for k in values if k.partition("|")[0] == name):
+                lbl, nums = key.partition("|")[2], values[key]
+                if types[name] == "counter":
+                    lines.append(f"{name}{{{lbl}}} {nums[0]}")
+                    continue
+                sep = "," if lbl else ""
+                for b, n in zip(Metrics.buckets, nums):
+                    lines.append(f'{name}_bucket{{{lbl}{sep}le="{b}"}} {n}')
+                lines.append(f'{name}_bucket{{{lbl}{sep}le="+Inf"}} {nums[-2]}')
+                lines.append(f"{name}_sum{{{lbl}}} {nums[-1]}")
+                lines.append(f"{name}_count{{{lbl}}} {nums[-2]}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        "Adds what's new to the totals in the cache dir and writes metrics.textfile"
+        textfile = ((_conf or {}).get("metrics") or {}).get("textfile")
+        if not textfile or not self.unsaved or not fcntl:
+            return
+        path = os.path.join(_cache_dir(), "metrics.json")
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # other gira processes
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (IOError, ValueError):
+                state = {"types": {}, "values": {}}
+            with self.lock:
+                state["types"].update(self.types)
+                for key, nums in self.unsaved.items():
+                    self._add(state["values"], key, nums)
+                self.unsaved = {}
+            _write_atomic(path, json.dumps(state))
+            _write_atomic(
+                os.path.expanduser(textfile), Metrics.render(state["types"], state["values"])
+            )
+
+    def serve(self, port):
+        "Serves metrics of this process on http://:port/metrics in the background"
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                with metrics.lock:
+                    body = Metrics.render(metrics.types, metrics.values).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+_metrics = Metrics()
+
+
+def _http_metrics(res, *args, **kwargs):
+    "requests response hook"
+    path = urllib.parse.urlparse(res.url).path
+    if "/api/v5/repos/" in path:  # gitee: /api/v5/repos/owner/repo/pulls/17/merge
+        backend, parts = "gitee", path.split("/")[6:]
+    else:  # jira: /rest/api/2/issue/CLOUD-1/transitions
+        backend, parts = "jira", path.partition("/rest/")[2].split("/")[2:]
+    if len(parts) > 1 and parts[1]:
+        parts[1] = ":id"
+    _metrics.inc(
+        "gira_http_requests_total",
+        backend=backend,
+        method=res.request.method,
+        endpoint="/".join(parts),
+        status=res.status_code,
+    )
+    _metrics.observe(
+        "gira_http_request_duration_seconds", res.elapsed.total_seconds(), backend=backend
+    )
+
+
+_http.hooks["response"].append(_http_metrics)
+
+
 class GiteeError(Exception):
     pass
 
 
+class Scheduler():
+    """Token bucket for the requests of one gitee token, shared by all threads.
+    Requests in the interactive lane go before background ones"""
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+    _all = {}
+    _all_lock = threading.Lock()
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.not_before = 0  # set by 429 or rate limit headers
+        self.waiting = [0, 0]
+        self.cond = threading.Condition()
+
+    @classmethod
+    def get(cls, token):
+        with cls._all_lock:
+            if token not in cls._all:
+                conf = _conf["gitee"] if _conf else {}
+                cls._all[token] = Scheduler(conf.get("rate", 5), conf.get("burst", 10))
+            return cls._all[token]
+
+    def acquire(self, lane):
+        with self.cond:
+            self.waiting[lane] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                    self.stamp = now
+                    yielding = lane == Scheduler.BACKGROUND and self.waiting[Scheduler.INTERACTIVE]
+                    if not yielding and now >= self.not_before and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    self.cond.wait(max(self.not_before - now, (1 - self.tokens) / self.rate, 0.01))
+            finally:
+                self.waiting[lane] -= 1
+                self.cond.notify_all()
+
+    def backoff(self, seconds):
+        with self.cond:
+            self.not_before = max(self.not_before, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def observe(self, res):
+        "Returns seconds to wait before retrying if res was rate limited, else None"
+        wait = None
+        if res.headers.get("Retry-After", "").isdigit():
+            wait = int(res.headers["Retry-After"])
+        elif res.headers.get("X-RateLimit-Remaining") == "0":
+            reset = res.headers.get("X-RateLimit-Reset", "")
+            if reset.isdigit():
+                reset = int(reset)
+                wait = reset - time.time() if reset > 1e9 else reset  # epoch or seconds
+        limited = res.status_code == 429 or (
+            res.status_code == 403 and "rate limit" in res.text.lower()
+        )
+        if wait is not None:
+            self.backoff(max(wait, 0))
+        if not limited:
+            return None
+        return 1 if wait is None else max(wait, 0)
+
+
 class Gitee():
     api_root = "https://gitee.com/api/v5/repos/{}/{}"
     web_root = "https://www.gitee.com/"
     allowed_permissions = ("push", "pull", "admin")
+    max_retries = 5
 
-    def __init__(self, user, token):
+    def __init__(self, user, token, path="."):
         self.user = user
         self.token = token
+        self.lane = Scheduler.INTERACTIVE
+        self.etags = None  # {url: response} for conditional GETs, used by watch
         # git rev-parse --show-toplevel
         # git command is not available before Repo()
         search = [".", "..", "../..", "../../..", "../../../..", "/you-will-never-find-me///"]
         for s in search:
             try:
-                self.git = Git(os.path.abspath(s))
+                self.git = Git(os.path.abspath(os.path.join(path, s)))
                 self.owner, self.repo = self.git.info()
                 break
             except git.exc.NoSuchPathError:
@@ -88,26 +322,48 @@ class Gitee():
     def _good_perm(self, perm):
         return perm in Gitee.allowed_permissions
 
+    def _request(self, method, url, **kwargs):
+        "All gitee API calls go through here to stay within the rate limit"
+        sched = Scheduler.get(self.token)
+        for attempt in range(Gitee.max_retries):
+            sched.acquire(self.lane)
+            res = _http.request(method, url, **kwargs)
+            wait = sched.observe(res)
+            if wait is None:
+                break
+            sched.backoff(max(wait, 2 ** attempt))
+        return res
+
     def get(self, url, params):
-        return requests.get(self._url(url, params))
+        url = self._url(url, params)
+        if self.etags is None:
+            return self._request("GET", url)
+        cached = self.etags.get(url)
+        headers = {"If-None-Match": cached.headers["ETag"]} if cached else {}
+        res = self._request("GET", url, headers=headers)
+        if res.status_code == 304 and cached:
+            return cached
+        if "ETag" in res.headers:
+            self.etags[url] = res
+        return res
 
     def put(self, url, _data):
         d = {"access_token": self.token, "owner": self.owner, "repo": self.repo}
         d.update(_data)
-        return requests.put(url, data=d)
+        return self._request("PUT", url, data=d)
 
     def patch(self, url, _data):
         d = {"access_token": self.token, "owner": self.owner, "repo": self.repo}
         d.update(_data)
-        return requests.patch(url, data=d)
+        return self._request("PATCH", url, data=d)
 
     def post(self, url, _data):
         d = {"access_token": self.token, "owner": self.owner, "repo": self.repo}
         d.update(_data)
-        return requests.post(url, data=d)
+        return self._request("POST", url, data=d)
 
     def delete(self, url):
-        return requests.delete(url)
+        return self._request("DELETE", url)
 
     def get_pr(self, pr):
         res = self.get(("pulls", pr), {})
@@ -151,6 +407,11 @@ class Gitee():
         if not res.status_code == 200:
             raise GiteeError(res.text)
 
+    def unlock_branch(self, branch):
+        res = self.delete(self._url(("branches", branch, "protection"), {}))
+        if res.status_code not in (200, 204):
+            raise GiteeError(res.text)
+
     def list_branch(self):
         res = self.get(("branches",), {})
         if not res.status_code == 200:
@@ -169,6 +430,51 @@ class Gitee():
             raise GiteeError(res.text)
         return res
 
+    def get_all(self, urls, params=None, per_page=100):
+        "Items from all pages of a list API"
+        items = []
+        page = 1
+        while True:
+            res = self.get(urls, dict(params or {}, page=page, per_page=per_page))
+            if not res.status_code == 200:
+                raise GiteeError(res.text)
+            batch = res.json()
+            if batch and batch[:1] == items[:1]:  # API without paging, all in one
+                return items
+            items.extend(batch)
+            if len(batch) < per_page:
+                return items
+            page += 1
+
+    def list_branches(self):
+        return self.get_all(("branches",))
+
+    def list_prs_since(self, since, state="all", per_page=100):
+        "PRs updated after since, newest first. Only reads the pages needed"
+        prs = []
+        page = 1
+        while True:
+            res = self.get(("pulls",), {
+                "state": state,
+                "sort": "updated",
+                "direction": "desc",
+                "page": page,
+                "per_page": per_page,
+            })
+            if not res.status_code == 200:
+                raise GiteeError(res.text)
+            batch = res.json()
+            for pr in batch:
+                if pr["updated_at"] <= since:
+                    return prs
+                prs.append(pr)
+            if len(batch) < per_page:
+                return prs
+            page += 1
+
+    def list_members(self):
+        return self.get_all(("collaborators",))
+
     def add_user(self, username, permission="push"):
         if not self._good_perm(permission):
             raise ValueError("invalid permission: {permission}")
@@ -208,6 +514,9 @@ class Gitee():
     def print_prs(self, pr):
         print(f"{pr['number']}: {pr['title']}")
 
+    def name(self):
+        return f"{self.owner}/{self.repo}"
+
     def goto_web(self):
         url = os.path.join(Gitee.web_root, self.owner, self.repo)
         _open_url(url)
@@ -221,6 +530,8 @@ class Gitee():
 
 
 class PR():
+    issue_pat = re.compile("^\s*([A-Z]*-\d*)\s+")
+
     def __init__(self, jsn):
         self.raw = jsn
         # TODO: handle exceptions
@@ -240,8 +551,7 @@ class PR():
         print(self.raw)
 
     def _get_jira_issue_id(self):
-        pat = re.compile("^\s*([A-Z]*-\d*)\s+")
-        mo = re.match(pat, self.title)
+        mo = re.match(PR.issue_pat, self.title)
         if not mo:
             raise ValueError(f"Invalid PR title: {self.title}")
         return mo.group(1)
@@ -257,11 +567,65 @@ class PR():
         return self.data[att]
 
 
+_issue_key = re.compile(r"^[A-Z]+-\d+$")
+
+
+def _pr_issue_key(data):
+    "JIRA issue ID of a PR JSON, or None if the title has no valid one"
+    try:
+        key = PR(json.dumps(data)).issue_id
+    except ValueError:
+        return None
+    return key if _issue_key.match(key) else None
+
+
+def _pr_issue_keys(prs):
+    return {k for k in map(_pr_issue_key, prs) if k}
+
+
+def _issue_ids(msg):
+    "JIRA issue IDs in a commit message, using the same rule as PR titles"
+    ids = []
+    for line in msg.splitlines():
+        line = re.sub(r"^!\d+\s+", "", line)  # gitee merge commit: "!17 CLOUD-1234 ..."
+        mo = re.match(PR.issue_pat, line + " ")
+        if mo and _issue_key.match(mo.group(1)):
+            ids.append(mo.group(1))
+    return ids
+
+
+class _TimedGitCmd(git.cmd.Git):
+    # bumped by commands that may move refs, so that Git.refs() reloads
+    generation = 0
+    ref_changing = {
+        "am", "branch", "checkout", "cherry-pick", "commit", "fetch", "merge",
+        "pull", "push", "rebase", "reset", "revert", "switch", "tag", "update-ref",
+        "worktree",
+    }
+
+    def execute(self, command, *args, **kwargs):
+        start = time.time()
+        op = command[1] if len(command) > 1 else command[0]
+        try:
+            return super().execute(command, *args, **kwargs)
+        finally:
+            if op in _TimedGitCmd.ref_changing:
+                self.generation += 1
+            _metrics.observe("gira_git_duration_seconds", time.time() - start, op=op)
+
+
+class _Repo(Repo):
+    GitCommandWrapperType = _TimedGitCmd
+
+
 class Git():
     def __init__(self, path="."):
         self.path = path
-        self.repo = Repo(self.path)
+        self.repo = _Repo(self.path)
         self.origin = self.repo.remotes["origin"].url
+        self._refs = None
+        self._remote = None
+        self._refs_gen = -1
 
     def info(self):
         p = giturlparse.parse(self.origin)
@@ -272,8 +636,31 @@ class Git():
     """get what to cherry pick from master latest commits,
     assuming that sandbox is pulled and have the latest code"""
     def get_head_parents(self, branch="master"):
-        head = self.repo.heads[branch]
-        return [p.hexsha for p in head.commit.parents]
+        return self.parents(self.refs()["refs/heads/" + branch])
+
+    def refs(self):
+        "All refs and their objects from one for-each-ref, reloaded once git moved refs"
+        if self._refs_gen != self.repo.git.generation:
+            gen = self.repo.git.generation
+            out = self.repo.git.for_each_ref("--format=%(objectname) %(refname)")
+            self._refs = {}
+            for line in out.splitlines():
+                sha, ref = line.split(" ", 1)
+                self._refs[ref] = sha
+            prefix = "refs/remotes/origin/"
+            self._remote = {
+                ref[len(prefix):]: sha
+                for ref, sha in self._refs.items()
+                if ref.startswith(prefix) and ref != prefix + "HEAD"
+            }
+            self._refs_gen = gen
+        return self._refs
+
+    def parents(self, rev):
+        "Parent commits, read through GitPython's persistent cat-file --batch process"
+        _, _, _, data = self.repo.git.get_object_data(rev)
+        header = data.decode("utf-8", "replace").partition("\n\n")[0]
+        return [l.split()[1] for l in header.splitlines() if l.startswith("parent ")]
 
     def current_branch(self):
         return self.repo.active_branch.name
@@ -285,15 +672,652 @@ class Git():
         current = self.current_branch()
         self.repo.git.checkout(base)
         self.repo.git.checkout(current)
-        bb = self.repo.merge_base(base, head)[0]  # FIXME: not sure why this is a list
-        base_head = self.repo.refs[base].commit
-        return bb.hexsha != base_head.hexsha
+        bb = self.repo.git.merge_base(base, head)
+        return bb != self.refs()["refs/heads/" + base]
+
+    def issue_commits(self, *revs):
+        "Map JIRA issue IDs to commits in revs. Scans the whole range with one git log"
+        out = self.repo.git.log("--format=%H%x1f%B%x1e", *revs)
+        found = {}
+        for rec in out.split("\x1e"):
+            sha, _, msg = rec.strip().partition("\x1f")
+            if not sha:
+                continue
+            for i in _issue_ids(msg):
+                found.setdefault(i, []).append(sha)
+        return found
+
+    def last_tag(self, rev):
+        "Most recent tag reachable from rev, excluding rev itself"
+        return self.repo.git.describe("--tags", "--abbrev=0", f"{rev}^")
+
+    def fetch(self):
+        self.repo.git.fetch("--prune", "origin")
+
+    def patch_ids(self, *revs, paths=()):
+        """Stable patch IDs of non-merge commits in revs, oldest first, mapped to commits.
+        With paths, only of commits touching them, but still over their whole diff"""
+        start = time.time()
+        limit = ["--full-diff", "--", *paths] if paths else []
+        log = subprocess.Popen(
+            ["git", "log", "-p", "--no-merges", "--reverse", *revs, *limit],
+            cwd=self.repo.working_dir,
+            stdout=subprocess.PIPE,
+        )
+        res = subprocess.run(
+            ["git", "patch-id", "--stable"],
+            cwd=self.repo.working_dir,
+            stdin=log.stdout,
+            stdout=subprocess.PIPE,
+        )
+        log.stdout.close()
+        if log.wait() != 0 or res.returncode != 0:
+            raise GitCommandError(["git", "log", "-p", *revs], log.returncode)
+        _metrics.observe("gira_git_duration_seconds", time.time() - start, op="patch-id")
+        ids = {}
+        for line in res.stdout.decode().splitlines():
+            pid, sha = line.split()
+            ids[pid] = sha
+        return ids
+
+    def is_ancestor(self, ancestor, rev):
+        try:
+            self.repo.git.merge_base("--is-ancestor", ancestor, rev)
+            return True
+        except GitCommandError:
+            return False
+
+    def gira_dir(self):
+        "Directory for gira's own state, shared by all worktrees of the repo"
+        common = self.repo.git.rev_parse("--git-common-dir")
+        d = os.path.join(os.path.abspath(os.path.join(self.repo.working_dir, common)), "gira")
+        os.makedirs(d, exist_ok=True)
+        return d
+
+    def scratch_base(self):
+        "Repo to create scratch worktrees from: this one, or a blobless clone with git.partial"
+        if not _conf.get("git", {}).get("partial"):
+            return self
+        path = os.path.join(_cache_dir(), "clones", *self.info())
+        if not os.path.exists(path):
+            _TimedGitCmd().clone("--filter=blob:none", "--no-checkout", self.origin, path)
+            clone = Git(path)
+            with self.repo.config_reader() as src, clone.repo.config_writer() as dst:
+                for key in ("name", "email"):  # commit as the same person
+                    if src.has_option("user", key):
+                        dst.set_value("user", key, src.get_value("user", key))
+        return Git(path)
+
+    def changed_paths(self, *revs):
+        return self.repo.git.diff("--name-only", *revs, "--").splitlines()
+
+    def remote_heads(self):
+        "Remote branches and their tip commits"
+        self.refs()
+        return self._remote
 
     def remote_branches(self):
-        for ref in self.repo.refs:
-            prefix = "refs/remotes/origin/"
-            if ref.path.startswith(prefix):
-                yield ref.path.partition(prefix)[2]
+        return self.remote_heads().keys()
+
+
+class RepoLock():
+    """flock of a clone, held while a command runs. Changing the working tree
+    takes the worktree's lock exclusively, so other worktrees of the same clone
+    can go on, and reading takes it shared. The clone's common lock is taken
+    shared too, or exclusively by commands rewriting state all worktrees share"""
+    SHARED = fcntl.LOCK_SH if fcntl else 1
+    EXCLUSIVE = fcntl.LOCK_EX if fcntl else 2
+
+    def __init__(self, path=".", worktree=SHARED, common=SHARED):
+        self.path = path
+        self.modes = (common, worktree)
+        self.files = []
+
+    def _lock_paths(self):
+        res = subprocess.run(
+            ["git", "rev-parse", "--git-dir", "--git-common-dir"],
+            cwd=self.path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        if res.returncode != 0:
+            return None, None  # not in a clone, nothing to protect
+        gitdir, common = [os.path.join(self.path, d) for d in res.stdout.decode().splitlines()]
+        # git-dir is the common dir in the main worktree, hence the subdir
+        os.makedirs(os.path.join(common, "gira"), exist_ok=True)
+        return os.path.join(common, "gira", "repo.lock"), os.path.join(gitdir, "gira.lock")
+
+    def __enter__(self):
+        if not fcntl:
+            return self
+        start = time.time()
+        # always common first, so that two gira can't wait for each other
+        for path, mode in zip(self._lock_paths(), self.modes):
+            if not path or not mode:
+                continue
+            f = open(path, "w")
+            self.files.append(f)
+            try:
+                fcntl.flock(f, mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("===> Waiting for another gira in this repo...", file=sys.stderr)
+                fcntl.flock(f, mode)
+        _metrics.observe("gira_lock_wait_seconds", time.time() - start)
+        return self
+
+    def __exit__(self, *exc):
+        for f in reversed(self.files):
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+        self.files = []
+
+
+def _locked(worktree, common=RepoLock.SHARED):
+    """Runs a command holding RepoLock of the current clone. worktree may be a
+    function of the command's arguments"""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            mode = worktree(**kwargs) if callable(worktree) else worktree
+            with RepoLock(".", mode, common):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+class Worktree():
+    """Worktree with a detached HEAD at rev that only has the given paths on disk.
+    Removed on exit unless a path to keep it at is given"""
+
+    def __init__(self, git, rev, paths, path=None):
+        self.base = git
+        self.rev = rev
+        self.paths = paths
+        self.keep = path is not None
+        self.path = path
+
+    def __enter__(self):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix="worktree-", dir=_cache_dir())
+            os.rmdir(self.path)  # git wants to create it
+        self.base.repo.git.worktree("add", "--detach", "--no-checkout", self.path, self.rev)
+        self.git = Git(self.path)
+        self.git.repo.git.sparse_checkout("set", "--no-cone", *self.paths)
+        self.git.repo.git.read_tree("-mu", "HEAD")  # materialize sparse paths only
+        return self
+
+    def __exit__(self, *exc):
+        if not self.keep:
+            self.base.repo.git.worktree("remove", "--force", self.path)
+        return False
+
+
+class WorktreePool():
+    """Worktrees of issue branches in the cache dir, made on first use. Later
+    uses fast-forward a clean worktree to what the background fetch of the use
+    before got. Beyond pool.max worktrees, the least recently used clean one
+    is removed"""
+
+    def __init__(self, git):
+        self.git = git
+        self.root = os.path.join(_cache_dir(), "worktrees", *git.info())
+        os.makedirs(self.root, exist_ok=True)
+        self.path = os.path.join(self.root, "pool.json")
+        self.used = {}  # branch -> last used
+        try:
+            with open(self.path) as f:
+                self.used = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def get(self, branch):
+        "Path of a worktree with branch checked out"
+        path = os.path.join(self.root, branch)
+        hit = os.path.exists(os.path.join(path, ".git"))
+        _metrics.inc("gira_cache_requests_total", cache="worktree", result="hit" if hit else "miss")
+        if hit:
+            with RepoLock(path, RepoLock.EXCLUSIVE):
+                wt = Git(path)
+                if not wt.repo.is_dirty():
+                    try:
+                        wt.repo.git.merge("--ff-only", "--quiet", "@{u}")
+                    except GitCommandError:
+                        pass  # no upstream, or local commits: left to the user
+            # only refs, detached so that it goes on after gira exits
+            subprocess.Popen(
+                ["git", "fetch", "--quiet", "origin", branch], cwd=path,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        else:
+            git = self.git.repo.git
+            git.worktree("prune")  # forget worktrees removed by hand
+            if f"refs/heads/{branch}" in self.git.refs():
+                git.worktree("add", path, branch)
+            else:
+                git.fetch("origin", branch)
+                git.worktree("add", "--track", "-b", branch, path, f"origin/{branch}")
+        self.used[branch] = time.time()
+        self.evict(keep=branch)
+        _write_atomic(self.path, json.dumps(self.used))
+        return path
+
+    def evict(self, keep):
+        limit = _conf.get("pool", {}).get("max", 5)
+        for branch in sorted(self.used, key=self.used.get):
+            if len(self.used) <= limit:
+                return
+            path = os.path.join(self.root, branch)
+            if branch == keep:
+                continue
+            if os.path.exists(path):
+                if Git(path).repo.is_dirty(untracked_files=True):
+                    continue  # somebody's work
+                self.git.repo.git.worktree("remove", path)
+            del self.used[branch]
+
+
+def _use_sparse(sparse, autocp=True):
+    "Whether merge picks in sparse worktrees, leaving the working tree alone"
+    if sparse is None:
+        sparse = _conf.get("git", {}).get("sparse", False)
+    return bool(autocp and sparse)
+
+
+def _use_pool(pool):
+    return pool if pool is not None else _conf.get("pool", {}).get("enabled", False)
+
+
+class IssueIndex():
+    """On-disk map of JIRA issue IDs to commits and the remote branches containing
+    them. Only branches matching git.index_branches are indexed"""
+
+    def __init__(self, git):
+        self.git = git
+        self.path = os.path.join(git.gira_dir(), "index.json")
+        self.tips = {}  # branch -> last indexed commit
+        self.commits = {}  # issue -> commits
+        self.branches = {}  # issue -> branches
+        try:
+            with open(self.path) as f:
+                d = json.load(f)
+            self.tips, self.commits, self.branches = d["tips"], d["commits"], d["branches"]
+        except (IOError, ValueError, KeyError):
+            pass  # rebuilt by update()
+
+    def save(self):
+        _write_atomic(self.path, json.dumps(
+            {"tips": self.tips, "commits": self.commits, "branches": self.branches}
+        ))
+
+    def _drop_branch(self, br):
+        self.tips.pop(br, None)
+        for brs in self.branches.values():
+            if br in brs:
+                brs.remove(br)
+
+    def _seed(self, br, tip):
+        """Gives br the issues it shares with an indexed branch, up to their merge
+        base, which is returned. Only the rest of br has to be scanned then"""
+        for other in sorted(self.tips, key=lambda b: b != "master"):
+            try:
+                base = self.git.repo.git.merge_base(tip, self.tips[other])
+            except GitCommandError:
+                continue  # unrelated histories
+            later = self.git.issue_commits(f"{base}..{self.tips[other]}")
+            for issue, brs in self.branches.items():
+                if other not in brs or br in brs:
+                    continue
+                after = set(later.get(issue, []))
+                if not after or any(
+                    self.git.is_ancestor(c, base) for c in self.commits[issue] if c not in after
+                ):
+                    brs.append(br)
+            return base
+        return None
+
+    def update(self):
+        "Index what has been added to remote branches since last update"
+        globs = _conf.get("git", {}).get("index_branches", ["master", "release-*"])
+        heads = {
+            br: tip for br, tip in self.git.remote_heads().items()
+            if any(fnmatch.fnmatchcase(br, g) for g in globs)
+        }
+        changed = False
+        for br in [b for b in self.tips if b not in heads]:
+            self._drop_branch(br)
+            changed = True
+        for br, tip in heads.items():
+            last = self.tips.get(br)
+            _metrics.inc(
+                "gira_cache_requests_total",
+                cache="issue_index",
+                result="hit" if last == tip else "miss",
+            )
+            if last == tip:
+                continue
+            if last and self.git.is_ancestor(last, tip):
+                revs = f"{last}..{tip}"
+            else:  # new or force pushed branch
+                self._drop_branch(br)
+                base = self._seed(br, tip)
+                revs = f"{base}..{tip}" if base else tip
+            for issue, shas in self.git.issue_commits(revs).items():
+                commits = self.commits.setdefault(issue, [])
+                commits.extend(c for c in shas if c not in commits)
+                brs = self.branches.setdefault(issue, [])
+                if br not in brs:
+                    brs.append(br)
+            self.tips[br] = tip
+            changed = True
+        if changed:
+            self.save()
+        return changed
+
+    def lookup(self, issue_id):
+        "Returns commits and remote branches for the issue"
+        return self.commits.get(issue_id, []), sorted(self.branches.get(issue_id, []))
+
+
+class Journal():
+    "Finished steps of a merge, kept on disk so that merge --continue can skip them"
+
+    def __init__(self, git, pr_no):
+        self.path = os.path.join(git.gira_dir(), f"merge-{pr_no}.json")
+        self.steps = {}
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.steps = json.load(f)
+            return True
+        except (IOError, ValueError):
+            return False
+
+    def done(self, step):
+        return step in self.steps
+
+    def get(self, step, default=None):
+        return self.steps.get(step, default)
+
+    def record(self, step, value=True):
+        self.steps[step] = value
+        _write_atomic(self.path, json.dumps(self.steps))
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
+
+
+class Store():
+    "Open PRs and their JIRA issues, kept up to date by gira prefetch"
+
+    def __init__(self, git):
+        self.path = os.path.join(git.gira_dir(), "prefetch.json")
+        self.fetched = 0
+        self.prs_updated = ""
+        self.prs = {}  # number -> PR JSON
+        self.issues = {}  # key -> raw issue JSON, with transitions
+        try:
+            with open(self.path) as f:
+                d = json.load(f)
+            self.fetched, self.prs_updated = d["fetched"], d["prs_updated"]
+            self.prs, self.issues = d["prs"], d["issues"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        _write_atomic(self.path, json.dumps({
+            "fetched": self.fetched,
+            "prs_updated": self.prs_updated,
+            "prs": self.prs,
+            "issues": self.issues,
+        }))
+
+    def fresh(self):
+        return time.time() - self.fetched < _conf.get("prefetch", {}).get("max_age", 900)
+
+    def pr(self, no):
+        "PR JSON like Gitee.get_pr() if we have it and it's fresh"
+        hit = self.fresh() and str(no) in self.prs
+        _metrics.inc("gira_cache_requests_total", cache="prefetch", result="hit" if hit else "miss")
+        return json.dumps(self.prs[str(no)]) if hit else None
+
+    def refresh(self, gitee, jira):
+        "Fetch what changed since last time, and git fetch in the meantime"
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            fetched = pool.submit(gitee.git.fetch)
+            if self.prs_updated:
+                changed = gitee.list_prs_since(self.prs_updated)
+            else:
+                changed = gitee.get_all(("pulls",), {"state": "open"})
+            for pr in changed:
+                if pr["state"] == "open":
+                    self.prs[str(pr["number"])] = pr
+                else:
+                    self.prs.pop(str(pr["number"]), None)
+                self.prs_updated = max(self.prs_updated, pr["updated_at"])
+
+            keys = _pr_issue_keys(self.prs.values())
+            known = [k for k in keys if k in self.issues]
+            new = [k for k in keys if k not in self.issues]
+            got = jira.search(new, "*all", expand="transitions")
+            got.update(jira.search_updated_since(known, self.fetched, "*all", "transitions"))
+            issues = {}
+            for k in keys:
+                if k in got:
+                    issues[k] = got[k].raw
+                elif k in self.issues:
+                    issues[k] = self.issues[k]
+            self.issues = issues
+            fetched.result()
+        self.fetched = start
+        self.save()
+        return changed, got
+
+
+class Mirror():
+    """PRs and their JIRA issues in .git/gira/mirror.db, updated by gira sync.
+    Text is searched with FTS5 if sqlite has it, with LIKE otherwise"""
+    issue_fields = "summary,status,fixVersions,issuetype,updated"
+
+    def __init__(self, git):
+        self.db = sqlite3.connect(os.path.join(git.gira_dir(), "mirror.db"))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS prs (
+                number INTEGER PRIMARY KEY, title TEXT, body TEXT, state TEXT,
+                head TEXT, base TEXT, author TEXT, reviewer TEXT, tester TEXT,
+                issue TEXT, url TEXT, created_at TEXT, updated_at TEXT);
+            CREATE TABLE IF NOT EXISTS issues (
+                key TEXT PRIMARY KEY, project TEXT, summary TEXT, status TEXT,
+                issuetype TEXT, fix_versions TEXT, updated TEXT);
+            CREATE INDEX IF NOT EXISTS prs_issue ON prs (issue);
+        """)
+        try:
+            self.db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5(kind, ref, body)"
+            )
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+
+    def get_meta(self, key, default=""):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    def _index(self, kind, ref, body):
+        if self.fts:
+            self.db.execute("DELETE FROM texts WHERE kind = ? AND ref = ?", (kind, ref))
+            self.db.execute("INSERT INTO texts VALUES (?, ?, ?)", (kind, ref, body))
+
+    def put_pr(self, data):
+        issue = _pr_issue_key(data)
+        first = lambda users: users[0]["login"] if users else ""
+        self.db.execute("INSERT OR REPLACE INTO prs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", (
+            data["number"], data["title"], data.get("body") or "", data["state"],
+            data["head"]["ref"], data["base"]["ref"], data["user"]["login"],
+            first(data.get("assignees")), first(data.get("testers")),
+            issue, data["html_url"], data["created_at"], data["updated_at"],
+        ))
+        self._index("pr", str(data["number"]), f"{data['title']}\n{data.get('body') or ''}")
+        return issue
+
+    def put_issue(self, isu):
+        f = isu.fields
+        self.db.execute("INSERT OR REPLACE INTO issues VALUES (?,?,?,?,?,?,?)", (
+            isu.key, isu.key.split("-")[0], f.summary, f.status.name, f.issuetype.name,
+            "\n".join(fv.name for fv in f.fixVersions), f.updated,
+        ))
+        self._index("issue", isu.key, f.summary)
+
+    def sync(self, gitee, jira):
+        "Mirror PRs updated since last sync and issues linked to PRs. Returns counts"
+        start = time.time()
+        since = self.get_meta("prs_updated")
+        if since:
+            changed = gitee.list_prs_since(since)
+        else:
+            changed = gitee.get_all(("pulls",), {"state": "all"})
+        keys = set()
+        for data in changed:
+            issue = self.put_pr(data)
+            if issue:
+                keys.add(issue)
+            since = max(since, data["updated_at"])
+
+        known = {r[0] for r in self.db.execute("SELECT key FROM issues")}
+        got = jira.search(keys - known, Mirror.issue_fields)
+        synced = float(self.get_meta("issues_synced", 0))
+        got.update(jira.search_updated_since(known, synced, Mirror.issue_fields))
+        for isu in got.values():
+            self.put_issue(isu)
+
+        self.set_meta("prs_updated", since)
+        self.set_meta("issues_synced", start)
+        self.db.commit()
+        return len(changed), len(got)
+
+    def search(self, text):
+        "[(kind, ref, title, state)] of PRs and issues mentioning text"
+        if self.fts:
+            rows = self.db.execute(
+                "SELECT kind, ref FROM texts WHERE texts MATCH ? ORDER BY rank", (text,)
+            ).fetchall()
+        else:
+            like = f"%{text}%"
+            rows = [("pr", str(r[0])) for r in self.db.execute(
+                "SELECT number FROM prs WHERE title LIKE ? OR body LIKE ?", (like, like))]
+            rows += [("issue", r[0]) for r in self.db.execute(
+                "SELECT key FROM issues WHERE summary LIKE ?", (like,))]
+        found = []
+        for kind, ref in rows:
+            if kind == "pr":
+                row = self.db.execute(
+                    "SELECT title, state FROM prs WHERE number = ?", (int(ref),)
+                ).fetchone()
+            else:
+                row = self.db.execute(
+                    "SELECT summary, status FROM issues WHERE key = ?", (ref,)
+                ).fetchone()
+            if row:
+                found.append((kind, ref) + tuple(row))
+        return found
+
+    def query(self, state=None, project=None, fix_version=None):
+        "PRs with their issue's status and fixVersions, newest first"
+        sql = """SELECT p.number, p.state, p.issue, p.title, p.url,
+                        i.status, i.fix_versions
+                 FROM prs p LEFT JOIN issues i ON p.issue = i.key WHERE 1"""
+        args = []
+        if state:
+            sql += " AND p.state = ?"
+            args.append(state)
+        if project:
+            sql += " AND i.project = ?"
+            args.append(project)
+        sql += " ORDER BY p.number DESC"
+        rows = self.db.execute(sql, args).fetchall()
+        if fix_version:
+            rows = [
+                r for r in rows
+                if any(fnmatch.fnmatchcase(fv, fix_version) for fv in (r[6] or "").split("\n"))
+            ]
+        return rows
+
+
+def _pr_events(old, new):
+    """Change events between two versions of a PR JSON. old is None for a PR not
+    seen before, which is only new if it's open"""
+    names = lambda users: {u["login"] for u in users}
+    events = []
+    if old is None:
+        if new["state"] != "open":
+            return events  # an old PR commented on, or opened and merged since
+        events.append(("new_pr", {}))
+    else:
+        added = names(new["assignees"]) - names(old["assignees"])
+        if added:
+            events.append(("reviewer_assigned", {"users": sorted(added)}))
+        added = names(new["testers"]) - names(old["testers"])
+        if added:
+            events.append(("tester_assigned", {"users": sorted(added)}))
+        if new["state"] != old["state"]:
+            events.append(("pr_state", {"from": old["state"], "to": new["state"]}))
+    was_good = old is not None and PR(json.dumps(old)).good()
+    if new["state"] == "open" and not was_good and PR(json.dumps(new)).good():
+        events.append(("ready", {}))
+    return events
+
+
+class Watcher():
+    "Last seen PRs and issue statuses of a repo. poll() only asks for what changed"
+
+    def __init__(self, gitee, jira, emit):
+        self.gitee = gitee
+        self.jira = jira
+        self.emit = emit
+        self.prs = {}  # number -> open PR JSON
+        self.status = {}  # issue -> status name
+        self.since = ""
+        self.polled = 0
+        gitee.lane = Scheduler.BACKGROUND
+        gitee.etags = {}
+
+    def poll(self):
+        start = time.time()
+        first = not self.polled
+        if not self.since:  # nothing seen yet, maybe no PR at all
+            changed = self.gitee.get_all(("pulls",), {"state": "open"})
+        else:
+            changed = self.gitee.list_prs_since(self.since)
+        for pr in sorted(changed, key=lambda pr: pr["updated_at"]):
+            no = str(pr["number"])
+            if not first:
+                for event, data in _pr_events(self.prs.get(no), pr):
+                    self.emit(event, self.gitee, pr=pr["number"], title=pr["title"], **data)
+            if pr["state"] == "open":
+                self.prs[no] = pr
+            else:
+                self.prs.pop(no, None)
+            self.since = max(self.since, pr["updated_at"])
+
+        keys = _pr_issue_keys(self.prs.values())
+        got = self.jira.search([k for k in keys if k not in self.status], "status")
+        known = [k for k in keys if k in self.status]
+        got.update(self.jira.search_updated_since(known, self.polled, "status"))
+        for key, isu in got.items():
+            st = isu.fields.status.name
+            if key in self.status and self.status[key] != st:
+                self.emit("issue_status", self.gitee, issue=key, **{"from": self.status[key], "to": st})
+            self.status[key] = st
+        self.status = {k: v for k, v in self.status.items() if k in keys}
+        self.polled = start
 
 
 class ReleaseVersion():
@@ -328,65 +1352,348 @@ class ReleaseVersion():
         return self.release
 
 
+def _release_branch(rv):
+    br = f"release-{rv.major}.{rv.minor}"
+    if rv.project:
+        br += f"-{rv.project}"
+    return br
+
+
+_transitions = ("in_progress", "done", "ready_for_test", "reopen")
+
+
+def _projects():
+    "JIRA project keys configured in gira.toml: the sections with transition IDs"
+    return [
+        k for k, v in _conf.items()
+        if isinstance(v, dict) and any(t in v for t in _transitions)
+    ]
+
+
 class MyJiraError(Exception):
     pass
 
 
-class MyJira():
+class JiraSession(requests.auth.AuthBase):
+    """JIRA cookie session kept in the cache dir, so that commands don't log in
+    or send the password again. Logs in again and retries on 401"""
+
     def __init__(self, url, user, passwd):
-        self.jira = JIRA(
-            _conf["jira"]["url"], auth=(_conf["jira"]["user"], _conf["jira"]["passwd"])
+        self.url = url
+        self.user = user
+        self.passwd = passwd
+        self.path = os.path.join(_cache_dir(), "jira-session.json")
+        self.cookies = {}
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                d = json.load(f)
+            if d["url"] == url and d["user"] == user:
+                self.cookies = d["cookies"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def login(self):
+        res = _http.post(
+            self.url.rstrip("/") + "/rest/auth/1/session",
+            json={"username": self.user, "password": self.passwd},
         )
+        if not res.status_code == 200:
+            raise MyJiraError(f"JIRA login failed: {res.status_code}")
+        self.cookies = res.cookies.get_dict()
+        _write_atomic(self.path, json.dumps(
+            {"url": self.url, "user": self.user, "cookies": self.cookies}
+        ), 0o600)
+
+    def _set_cookies(self, req):
+        req.headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        req.gira_cookies = self.cookies
+
+    def __call__(self, req):
+        with self.lock:
+            if not self.cookies:
+                self.login()
+        self._set_cookies(req)
+        req.register_hook("response", self._retry_401)
+        return req
+
+    def _retry_401(self, res, **kwargs):
+        if res.status_code != 401 or getattr(res.request, "gira_retried", False):
+            return res
+        with self.lock:
+            if res.request.gira_cookies is self.cookies:  # no other thread did it
+                self.login()
+        res.content  # release the connection
+        res.close()
+        req = res.request.copy()
+        req.gira_retried = True
+        self._set_cookies(req)
+        again = res.connection.send(req, **kwargs)
+        again.history.append(res)
+        again.request = req
+        return again
+
+
+_jira_clients = {}
+_jira_clients_lock = threading.Lock()
+
+
+def _jira_client(url, user, passwd):
+    "One JIRA client per process, without the server info round trip"
+    with _jira_clients_lock:
+        if (url, user) not in _jira_clients:
+            client = JIRA(url, get_server_info=False)
+            client._session.auth = JiraSession(url, user, passwd)
+            client._session.hooks["response"].append(_http_metrics)
+            _jira_clients[(url, user)] = client
+        return _jira_clients[(url, user)]
+
+
+class VersionCatalog():
+    """Versions of a JIRA project, cached in the cache dir for
+    jira.versions_max_age seconds and indexed by release branch"""
+
+    def __init__(self, jira, project):
+        self.jira = jira
+        self.project = project
+        d = os.path.join(_cache_dir(), "versions")
+        os.makedirs(d, exist_ok=True)
+        self.path = os.path.join(d, f"{project}.json")
+        self.fetched = 0
+        self.versions = {}  # name -> {"released": bool, "archived": bool}
+        self.refreshed = False
+        try:
+            with open(self.path) as f:
+                d = json.load(f)
+            self.fetched, self.versions = d["fetched"], d["versions"]
+        except (IOError, ValueError, KeyError):
+            pass
+        self._index()
+
+    def _index(self):
+        self.branches = {}  # release branch -> [ReleaseVersion]
+        for name in self.versions:
+            rv = ReleaseVersion(name)
+            if rv.is_semver:
+                self.branches.setdefault(_release_branch(rv), []).append(rv)
+
+    def fresh(self):
+        return time.time() - self.fetched < _conf["jira"].get("versions_max_age", 3600)
+
+    def refresh(self):
+        self.versions = {
+            v.name: {
+                "released": getattr(v, "released", False),
+                "archived": getattr(v, "archived", False),
+            }
+            for v in self.jira.project_versions(self.project)
+        }
+        self.fetched = time.time()
+        self.refreshed = True
+        self._index()
+        _write_atomic(self.path, json.dumps({"fetched": self.fetched, "versions": self.versions}))
+
+    def get(self, name):
+        "Version info, or None if JIRA doesn't know it. Refetched if name is new"
+        hit = self.fresh() and name in self.versions
+        _metrics.inc("gira_cache_requests_total", cache="versions", result="hit" if hit else "miss")
+        if not hit and not self.refreshed:
+            self.refresh()
+        return self.versions.get(name)
+
+    def open_trunks(self):
+        "Unreleased x.y.0 versions of the product, newest first"
+        if not self.fresh():
+            self.refresh()
+        trunks = [
+            rv for rvs in self.branches.values() for rv in rvs
+            if rv.fix == "0" and not rv.project
+            and not self.versions[rv.release]["released"]
+            and not self.versions[rv.release]["archived"]
+        ]
+        trunks.sort(key=lambda rv: (int(rv.major), int(rv.minor)), reverse=True)
+        return [rv.release for rv in trunks]
+
+
+# JIRA writes nobody waits for, finished before the command exits
+_jira_writer = ThreadPoolExecutor(max_workers=1)
+_jira_writes = []
+
+
+def _join_jira_writes():
+    while _jira_writes:
+        issue_id, fut = _jira_writes.pop(0)
+        if fut.exception():
+            print(f"Failed to update {issue_id}: {fut.exception()}", file=sys.stderr)
+
+
+class MyJira():
+    search_batch = 100
+
+    def __init__(self, url, user, passwd):
+        self.jira = _jira_client(url, user, passwd)
         self.url = url
+        self._issues = {}
+        self._warm = {}
+        self._store = None
+        self._pending = {}
+        self._catalogs = {}
+
+    def versions(self, project):
+        "VersionCatalog of project, shared by all issues"
+        if project not in self._catalogs:
+            self._catalogs[project] = VersionCatalog(self.jira, project)
+        return self._catalogs[project]
+
+    def issue(self, issue_id):
+        "Issue fetched once and shared by all getters until it's changed"
+        if issue_id not in self._issues:
+            if issue_id in self._warm:
+                raw = self._warm[issue_id]
+                self._issues[issue_id] = Issue(self.jira._options, self.jira._session, raw=raw)
+            else:
+                self._issues[issue_id] = self.jira.issue(issue_id)
+        return self._issues[issue_id]
+
+    def preload(self, issue_ids, fields="summary,status,fixVersions,issuetype"):
+        "Fetch many issues with one search instead of one request each"
+        new = [i for i in issue_ids if i not in self._issues and i not in self._warm]
+        if new:
+            self._issues.update(self.search(new, fields))
+
+    def forget(self, issue_id):
+        self._issues.pop(issue_id, None)
+        self._warm.pop(issue_id, None)
+
+    def warm(self, store):
+        "Read issues from gira prefetch instead of JIRA while they are fresh"
+        if store.fresh():
+            self._warm = dict(store.issues)
+            self._store = store
+
+    def _check_fresh(self, issue_id):
+        "Refuse to write an issue checked against prefetched data that has changed since"
+        if issue_id not in self._warm:
+            return
+        cached = self._warm[issue_id]["fields"].get("updated")
+        now = self.jira.issue(issue_id, fields="updated").fields.updated
+        if now != cached:
+            self._store.issues.pop(issue_id, None)  # don't trust it next time
+            self._store.save()
+            raise MyJiraError(f"{issue_id} changed since gira prefetch. Run it again")
+
+    def queue(self, issue_id, comment=None, transition=None, fields=None):
+        "Queue changes to an issue until flush() sends them together"
+        p = self._pending.setdefault(
+            issue_id, {"comments": [], "transition": None, "fields": {}}
+        )
+        if comment:
+            p["comments"].append(comment)
+        if transition:
+            p["transition"] = transition
+        if fields:
+            p["fields"].update(fields)
+
+    def flush(self, issue_id=None, wait=True):
+        """Send queued changes, one request per issue if JIRA allows.
+        With wait=False they are sent in background before gira exits."""
+        for i in [issue_id] if issue_id else list(self._pending):
+            p = self._pending.pop(i, None)
+            if not p:
+                continue
+            if wait:
+                self._send(i, p)
+            else:
+                _jira_writes.append((i, _jira_writer.submit(self._send, i, p)))
 
-    def update_issue(self, issue_id, comment, transition):
-        issue = self.jira.issue(issue_id)
+    def _send(self, issue_id, p):
+        comment = "\n\n".join(p["comments"]) or None
+        try:
+            self._check_fresh(issue_id)
+            if p["transition"]:
+                # a transition screen can carry the comment and fields
+                try:
+                    self.jira.transition_issue(
+                        issue_id, p["transition"],
+                        fields=p["fields"] or None, comment=comment,
+                    )
+                    return
+                except JIRAError:
+                    if not (comment or p["fields"]):
+                        raise
+                # maybe not on the screen: transit first, so that a failed
+                # transition doesn't leave a comment behind for a retry to repeat
+                self.jira.transition_issue(issue_id, p["transition"])
+                self._edit(issue_id, p["fields"], comment)
+            else:
+                self._edit(issue_id, p["fields"], comment)
+        finally:
+            self.forget(issue_id)
+
+    def _edit(self, issue_id, fields, comment):
+        "Fields and a comment in one PUT, without reloading the issue"
+        data = {}
+        if fields:
+            data["fields"] = fields
+        if comment:
+            data["update"] = {"comment": [{"add": {"body": comment}}]}
+        if data:
+            url = self.jira._get_url(f"issue/{issue_id}")
+            self.jira._session.put(url, data=json.dumps(data))
+
+    def update_issue(self, issue_id, comment, transition, wait=True):
         project, _ = issue_id.split("-")  # assuming format
-        self.jira.add_comment(issue_id, comment)
-        if transition:
-            self.jira.transition_issue(issue.key, _conf[project][transition])
+        self.queue(issue_id, comment, _conf[project][transition] if transition else None)
+        self.flush(issue_id, wait)
 
     def start_on_issue(self, issue_id, component, transition):
-        issue = self.jira.issue(issue_id)
-        issue.update(fields={"components": [{ "name": component }]})
-        self.jira.transition_issue(issue.key, transition)
+        self.queue(issue_id, transition=transition,
+                   fields={"components": [{"name": component}]})
+        self.flush(issue_id)
 
     def finish_issue(self, issue_id, comment):
         self.update_issue(issue_id, comment, "ready_for_test")
 
     def get_fix_versions(self, issue_id):
-        issue = self.jira.issue(issue_id)
+        issue = self.issue(issue_id)
         return [fv.name for fv in issue.fields.fixVersions]
 
     def get_issue_status(self, issue_id):
-        issue = self.jira.issue(issue_id)
+        issue = self.issue(issue_id)
         return issue.fields.status.name
 
-    def get_trunk_fix_version(self, issue_id):
-        fv = self.get_fix_versions(issue_id)
-        for f in fv:
+    def _trunk_fv(self, fvs):
+        for f in fvs:
             rv = ReleaseVersion(f)
             if rv.fix == "0":  # '0' means trunk
                 return f  # Assuming there is only one
         return None
 
-    def get_trunk_branch(self, issue_id):
-        fv = self.get_trunk_fix_version(issue_id)
+    def get_trunk_fix_version(self, issue_id):
+        return self._trunk_fv(self.get_fix_versions(issue_id))
+
+    def _trunk_br(self, fvs):
+        fv = self._trunk_fv(fvs)
         if not fv:
             return ""
         rv = ReleaseVersion(fv)
         return f"release-{rv.major}.{rv.minor}"
 
+    def get_trunk_branch(self, issue_id):
+        return self._trunk_br(self.get_fix_versions(issue_id))
+
     def _target_br(self, fvs):
         master = False
         rv = None
         for fv in fvs:
+            if not ReleaseVersion(fv).is_semver:
+                continue
             rv = ReleaseVersion(fv)
             if rv.fix == "0":  # '0' means trunk
                 master = True
                 break
-        if not master:
-            return f"release-{rv.major}.{rv.minor}"
+        if not master and rv:
+            return _release_branch(rv)
         return "master"
 
     def get_target_branch(self, issue_id):
@@ -396,29 +1703,62 @@ class MyJira():
     def trunk_required(self, issue_id):
         return self.get_trunk_fix_version(issue_id) is not None
 
-    def get_cherry_pick_branches(self, issue_id, ignore_trunk=True):
-        fv = self.get_fix_versions(issue_id)
+    def _cherry_pick_brs(self, fvs):
         branches = []
-        for f in fv:
+        for f in fvs:
             rv = ReleaseVersion(f)
             if not rv.is_semver or rv.fix == "0":  # '0' means trunk
                 continue
-            rel = f"release-{rv.major}.{rv.minor}"
-            if rv.project:
-                rel += f"-{rv.project}"
-            branches.append(rel)
+            branches.append(_release_branch(rv))
         return branches
 
-    def list_transitions(self, issue_id):
-        jra = JIRA(
-            _conf["jira"]["url"], auth=(_conf["jira"]["user"], _conf["jira"]["passwd"])
+    def get_cherry_pick_branches(self, issue_id, ignore_trunk=True):
+        return self._cherry_pick_brs(self.get_fix_versions(issue_id))
+
+    def search(self, issue_ids, fields="summary,status,fixVersions,issuetype", where="", expand=None):
+        "Fetch many issues with batched JQL searches. Unknown or malformed issues are left out."
+        issue_ids = sorted({i for i in issue_ids if _issue_key.match(i)})
+        found = {}
+        for i in range(0, len(issue_ids), MyJira.search_batch):
+            batch = issue_ids[i:i + MyJira.search_batch]
+            jql = "key in (%s)" % ",".join(batch)
+            if where:
+                jql += f" AND {where}"
+            for isu in self.jira.search_issues(
+                jql, maxResults=len(batch), fields=fields, expand=expand, validate_query=False
+            ):
+                found[isu.key] = isu
+        return found
+
+    def search_updated_since(self, issue_ids, since, fields, expand=None):
+        "Like search() but only issues updated since the time since, if given"
+        where = ""
+        if since:  # with a margin for clock skew
+            where = "updated >= -%dm" % (int((time.time() - since) / 60) + 5)
+        return self.search(issue_ids, fields, where, expand)
+
+    def query(self, jql, fields="summary,status,fixVersions,issuetype"):
+        "All issues matching jql, restricted to configured projects"
+        if _projects():
+            jql = "project in (%s) AND (%s)" % (",".join(_projects()), jql)
+        issues = self.jira.search_issues(
+            jql, maxResults=False, fields=fields, validate_query=False
         )
-        trs = jra.transitions(issue_id)
+        return {isu.key: isu for isu in issues}
+
+    def issues_in_version(self, version, fields="summary,status,fixVersions,issuetype"):
+        return self.query(f'fixVersion = "{version}"', fields)
+
+    def list_transitions(self, issue_id):
+        if "transitions" in self._warm.get(issue_id, {}):
+            trs = self._warm[issue_id]["transitions"]
+        else:
+            trs = self.jira.transitions(issue_id)
         for tr in trs:
             print(f"ID: {tr['id']}, Name: {tr['name']}")
 
     def _get_field(self, issue_id, field):
-        isu = self.jira.issue(issue_id)
+        isu = self.issue(issue_id)
         return getattr(isu.fields, field)
 
     def get_summary(self, issue_id):
@@ -432,39 +1772,42 @@ class MyJira():
         return os.path.join(self.url, "browse", issue_id)
 
     def push_off(self, issue_id, frm, to):
-        issue = self.jira.issue(issue_id)
+        issue = self.issue(issue_id)
         newfv = []
         for fv in issue.fields.fixVersions:
             if fv.name == frm:
                 newfv.append({"name": to})
             else:
                 newfv.append({"name": fv.name})
-        issue.update(fields={"fixVersions": newfv})
+        self.queue(issue_id, fields={"fixVersions": newfv})
+        self.flush(issue_id)
 
     def include(self, issue_id, version):
-        issue = self.jira.issue(issue_id)
+        issue = self.issue(issue_id)
         newfv = []
         for fv in issue.fields.fixVersions:
             if fv.name == version:
                 return
             newfv.append({"name": fv.name})
         newfv.append({"name": version})
-        issue.update(fields={"fixVersions": newfv})
+        self.queue(issue_id, fields={"fixVersions": newfv})
+        self.flush(issue_id)
 
     def exclude(self, issue_id, version):
-        issue = self.jira.issue(issue_id)
+        issue = self.issue(issue_id)
         newfv = []
         for fv in issue.fields.fixVersions:
             if fv.name != version:
                 newfv.append({"name": fv.name})
-        issue.update(fields={"fixVersions": newfv})
+        self.queue(issue_id, fields={"fixVersions": newfv})
+        self.flush(issue_id)
 
     def has_children(self, issue_id):
-        issue = self.jira.issue(issue_id)
+        issue = self.issue(issue_id)
         return len(issue.fields.subtasks) > 0
 
     def is_epic(self, issue_id):
-        issue = self.jira.issue(issue_id)
+        issue = self.issue(issue_id)
         return issue.fields.issuetype.name == "Epic"
 
     def goto_issue(self, issue_id):
@@ -472,8 +1815,20 @@ class MyJira():
 
 
 @click.group()
-def main():
-    pass
+@click.pass_context
+def main(ctx):
+    start = time.time()
+
+    def done():
+        _join_jira_writes()
+        _metrics.observe(
+            "gira_command_duration_seconds",
+            time.time() - start,
+            command=ctx.invoked_subcommand,
+        )
+        _metrics.flush()
+
+    ctx.call_on_close(done)
 
 
 def _good_jira_issue(jira, issue_id, force=False):
@@ -488,6 +1843,15 @@ def _good_jira_issue(jira, issue_id, force=False):
     if jira.has_children(issue_id) or jira.is_epic(issue_id):
         print("Refusing to merge issue with subtask or Epic")
         return False
+    catalog = jira.versions(issue_id.split("-")[0])
+    for v in vers:
+        info = catalog.get(v)
+        if info is None:
+            print(f"fixVersion {v} doesn't exist in JIRA. Giving up.")
+            return False
+        if (info["released"] or info["archived"]) and not force:
+            print(f"fixVersion {v} is already released or archived. Giving up.")
+            return False
 
     # fixVersion can be:
     # 1. x.y.0 for trunk
@@ -510,11 +1874,11 @@ def _good_jira_issue(jira, issue_id, force=False):
     if trunk > 1:
         print("Jira issue assigned assigned to multiple major version. Giving up.")
         return False
-    if not trunk and bug_fix and not force:
-        print("Bug fixes has to go to master. Giving up.")
-        return False
-    if not trunk and proj_fix and not force:
+    if not trunk and (bug_fix or proj_fix) and not force:
         print("Bug fixes has to go to master. Giving up.")
+        trunks = catalog.open_trunks()
+        if trunks:
+            print(f"Latest open trunk version is {trunks[0]}.")
         return False
     return True
 
@@ -528,32 +1892,121 @@ def all_is_well(gitee, pr, jira, force):
         print(f"\n{pr.html_url}")
         return False
 
-    return _good_jira_issue(jira, pr.issue_id, force)
+    if not _good_jira_issue(jira, pr.issue_id, force):
+        return False
+    target = jira.get_target_branch(pr.issue_id)
+    if pr.base["ref"] != target and not force:
+        print(f"PR goes to {pr.base['ref']} but fixVersions say {target}. Giving up.")
+        return False
+    return True
 
 
-def cherry_pick_real(git, branches, frm, to):
+def _pick_plan(local, frm, to):
+    "Commits in frm..to, oldest first, and their patch IDs"
+    commits = local.repo.git.rev_list("--reverse", f"{frm}..{to}").split()
+    return commits, local.patch_ids(f"{frm}..{to}")
+
+
+def _unpicked(local, plan, to, br, paths=()):
+    """Commits of plan that origin/br has no equivalent of, like git cherry.
+    Only commits on br since it forked from to are compared. An equivalent
+    patch touches the same files, so paths, the files plan changes, can be
+    given to skip the rest. That saves a partial clone many blob fetches"""
+    commits, pids = plan
+    have = local.patch_ids(f"{to}..origin/{br}", paths=paths)
+    done = {sha for pid, sha in pids.items() if pid in have}
+    return [c for c in commits if c not in done]
+
+
+def cherry_pick_real(local, branches, frm, to, journal=None):
+    git = local.repo.git
     git.checkout("master")
     git.pull()
+    plan = _pick_plan(local, frm, to)
     for br in branches:
+        if journal and journal.done(f"picked:{br}"):
+            print(f"{br} is already done. Skipped.")
+            continue
         print(f"switching to {br}...")
         git.checkout(br)
-        print(f"pulling from remote repo...")
-        git.pull()
-        print(f"cherry picking {frm}..{to}...")
-        git.cherry_pick(f"{frm}..{to}")
+        if (journal and journal.get("failed") == br
+                and int(git.rev_list("--count", f"origin/{br}..{br}"))):
+            print(f"found local commits, assuming cherry pick was fixed by hand...")
+        else:
+            print(f"pulling from remote repo...")
+            git.pull()
+            commits = _unpicked(local, plan, to, br)
+            if not commits:
+                print(f"{br} already has all changes of {frm}..{to}. Skipped.")
+                _metrics.inc("gira_cherry_picks_total", branch=br, result="skipped")
+                if journal:
+                    journal.record(f"picked:{br}")
+                git.checkout("master")
+                continue
+            print(f"cherry picking {len(commits)} of {frm}..{to}...")
+            try:
+                git.cherry_pick(*commits)
+            except GitCommandError:
+                _metrics.inc("gira_cherry_picks_total", branch=br, result="failure")
+                if journal:
+                    journal.record("failed", br)
+                raise
         print(f"pushing to remote repo...")
         git.push()
+        _metrics.inc("gira_cherry_picks_total", branch=br, result="success")
+        if journal:
+            journal.record(f"picked:{br}")
         print(f"switching to master...")
         git.checkout("master")
 
 
-def cherry_pick(git, branches, frm, to, doit=True):
+def cherry_pick_sparse(local, branches, frm, to, journal=None):
+    """Like cherry_pick_real but in throwaway sparse worktrees that only have the
+    files touched by frm..to, so that the working tree is never switched"""
+    base = local.scratch_base()
+    print(f"fetching from remote repo...")
+    base.fetch()
+    paths = base.changed_paths(f"{frm}...{to}")  # only what the PR changed
+    plan = _pick_plan(base, frm, to)
+    for br in branches:
+        if journal and journal.done(f"picked:{br}"):
+            print(f"{br} is already done. Skipped.")
+            continue
+        if (journal and journal.get("failed") == br and f"refs/heads/{br}" in local.refs()
+                and int(local.repo.git.rev_list("--count", f"origin/{br}..{br}"))):
+            print(f"found local commits on {br}, assuming cherry pick was fixed by hand...")
+            local.repo.git.push("origin", f"{br}:{br}")
+        else:
+            commits = _unpicked(base, plan, to, br, paths)
+            if not commits:
+                print(f"{br} already has all changes of {frm}..{to}. Skipped.")
+                _metrics.inc("gira_cherry_picks_total", branch=br, result="skipped")
+                if journal:
+                    journal.record(f"picked:{br}")
+                continue
+            print(f"cherry picking {len(commits)} of {frm}..{to} to {br} in a sparse worktree...")
+            with Worktree(base, f"origin/{br}", paths) as wt:
+                try:
+                    wt.git.repo.git.cherry_pick(*commits)
+                except GitCommandError:
+                    _metrics.inc("gira_cherry_picks_total", branch=br, result="failure")
+                    if journal:
+                        journal.record("failed", br)
+                    raise
+                print(f"pushing to remote repo...")
+                wt.git.repo.git.push("origin", f"HEAD:refs/heads/{br}")
+        _metrics.inc("gira_cherry_picks_total", branch=br, result="success")
+        if journal:
+            journal.record(f"picked:{br}")
+
+
+def cherry_pick(local, branches, frm, to, doit=True, journal=None):
     """tries to automatically cherry-pick to the correct release branch from
     master"""
     if not branches:
         return
     if doit:
-        cherry_pick_real(git, branches, frm, to)
+        cherry_pick_real(local, branches, frm, to, journal)
         return
     print()
     print("1. Run the following commands")
@@ -566,6 +2019,62 @@ def cherry_pick(git, branches, frm, to, doit=True):
         print(f"git cherry-pick {frm}..{to}")
 
 
+def _audit(git, jira, issues, workers=8):
+    """Returns {issue: (commits, missing branches, partly picked branches)}.
+    A branch has the change if it has as many patch IDs of the issue's commits
+    as master has: the same patches, or reworked picks with the issue in their
+    message"""
+    index = IssueIndex(git)
+    index.update()
+    heads = git.remote_heads()
+    todo = {}
+    for key, isu in issues.items():
+        fvs = [fv.name for fv in isu.fields.fixVersions]
+        brs = jira._cherry_pick_brs(fvs)
+        tbr = jira._trunk_br(fvs)
+        if tbr in heads:
+            brs.append(tbr)
+        todo[key] = brs
+
+    def issue_pids(key):
+        "Patch IDs of all commits of the issue, and of those on master"
+        pids, trunk = set(), set()
+        for c in index.lookup(key)[0]:
+            try:
+                got = set(git.patch_ids(f"{c}^1..{c}"))
+            except GitCommandError:
+                continue  # root commit
+            pids |= got
+            if git.is_ancestor(c, "origin/master"):
+                trunk |= got
+        return pids, trunk or pids
+
+    def branch_pids(br):
+        return set(git.patch_ids(f"origin/master..origin/{br}"))
+
+    keys = [k for k in todo if todo[k] and index.lookup(k)[0]]
+    brs = list({br for k in keys for br in todo[k] if br in heads})
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        bpids = dict(zip(brs, pool.map(branch_pids, brs)))
+        ipids = dict(zip(keys, pool.map(issue_pids, keys)))
+
+    result = {}
+    for key in sorted(todo):
+        missing, partial = [], []
+        for br in todo[key]:
+            if key not in ipids or br not in bpids:
+                missing.append(br)
+                continue
+            pids, trunk = ipids[key]
+            have = len(pids & bpids[br])
+            if not have:
+                missing.append(br)
+            elif have < len(trunk):
+                partial.append(br)
+        result[key] = (index.lookup(key)[0], missing, partial)
+    return result
+
+
 @main.command()
 @click.option(
     "--force/--no-force",
@@ -577,51 +2086,100 @@ def cherry_pick(git, branches, frm, to, doit=True):
     default=True,
     help="Automatically cherry pick to various release branches",
 )
+@click.option(
+    "--continue",
+    "cont",
+    is_flag=True,
+    help="Resume an unfinished merge, skipping steps that are done",
+)
+@click.option(
+    "--sparse/--no-sparse",
+    default=None,
+    help="Cherry pick in sparse worktrees with only the changed files. Default: git.sparse",
+)
 @click.argument("no")
-def merge(no, force, autocp):
+@_locked(
+    lambda sparse, autocp, **_:
+        RepoLock.SHARED if _use_sparse(sparse, autocp) else RepoLock.EXCLUSIVE
+)
+def merge(no, force, autocp, cont, sparse):
     "Merge PR and resolve JIRA issue"
+    sparse = _use_sparse(sparse, autocp)
     user = _conf["gitee"]["user"]
     token = _conf["gitee"]["token"]
     try:
         gitee = Gitee(user, token)
-        if gitee.git.repo.is_dirty():
+        journal = Journal(gitee.git, no)
+        if cont and not journal.load():
+            print(f"No unfinished merge of PR {no} to continue.")
+            return 6
+        if not cont and journal.exists():
+            print(f"Merge of PR {no} didn't finish. Use --continue to resume it")
+            print(f"or remove {journal.path} to start over.")
+            return 6
+    except GiteeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    # independent of each other, decide once all of them are back
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        dirty = pool.submit(gitee.git.repo.is_dirty)
+        fetched = pool.submit(gitee.git.fetch)
+        get_pr = pool.submit(lambda: PR(gitee.get_pr(no)))
+        get_jira = pool.submit(
+            MyJira, _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
+        )
+
+        def get_issue():
+            try:
+                get_jira.result().issue(get_pr.result().issue_id)
+            except ValueError:
+                pass  # bad PR title, all_is_well() tells
+
+        get_issue = pool.submit(get_issue)
+    try:
+        if dirty.result() and not sparse:
             print("Working directory seems to be dirty. Refusing to continue.")
             return 1
-        pr = PR(gitee.get_pr(no))
-        jira = MyJira(
-            _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
-        )
+        pr, jira = get_pr.result(), get_jira.result()
+        fetched.result()
+        get_issue.result()
         print(f"===> Processing PR for: {pr.issue_id} {jira.get_summary(pr.issue_id)}")
-    except GiteeError as e:
+    except (GiteeError, GitCommandError) as e:
         print(f"Error: {e}", file=sys.stderr)
         return 1
 
-    if not all_is_well(gitee, pr, jira, force):
-        return 0
+    # the journal starts with "merged", so an unmerged PR is always checked
+    if not journal.done("merged"):
+        if not all_is_well(gitee, pr, jira, force):
+            return 0
 
-    if pr.head == "master" and force:
-        print("'force' only allowed for project specific bug fixes. Giving up.")
-        return 4
+        if pr.head == "master" and force:
+            print("'force' only allowed for project specific bug fixes. Giving up.")
+            return 4
 
-    # used to be pr.head but there seems to be problem with gitee API
-    if pr.base['label'] != "master" and jira.trunk_required(pr.issue_id):
-        print("Jira fix version includes trunk but only merging to branch.")
-        print("Perhaps you should split the Jira issue. Giving up.")
-        print(f"\n\n\nbase: {pr.base}, issue: {pr.issue_id}")
-        return 5
+        # used to be pr.head but there seems to be problem with gitee API
+        if pr.base['label'] != "master" and jira.trunk_required(pr.issue_id):
+            print("Jira fix version includes trunk but only merging to branch.")
+            print("Perhaps you should split the Jira issue. Giving up.")
+            print(f"\n\n\nbase: {pr.base}, issue: {pr.issue_id}")
+            return 5
 
     try:
-        if not pr.merged():
+        if not pr.merged() and not journal.done("merged"):
             print(f"===> Merging PR {no}...")
             gitee.merge(no)
-        comment = "PR %d signed off by %s and %s.\n%s" % (
-            pr.number,
-            pr.reviwer,
-            pr.tester,
-            pr.html_url,
-        )
-        print(f"===> Updating jira issue status...")
-        jira.update_issue(pr.issue_id, comment, "done")
+        journal.record("merged")
+        if not journal.done("resolved"):
+            comment = "PR %d signed off by %s and %s.\n%s" % (
+                pr.number,
+                pr.reviwer,
+                pr.tester,
+                pr.html_url,
+            )
+            print(f"===> Updating jira issue status...")
+            jira.update_issue(pr.issue_id, comment, "done")
+            journal.record("resolved")
         fv = jira.get_fix_versions(pr.issue_id)
         if fv:
             print(f"fixVersions: {', '.join(fv)}")
@@ -634,23 +2192,36 @@ def merge(no, force, autocp):
     # TODO: catch JIRA exception
 
     if force:  # FIXME: this is leaky but let's assume it's OK
+        journal.remove()
         return 0
 
     # this has to be done to make sure that local clone has the latest commit
-    try:
-        print(f"===> Updating to latest master...")
-        gitee.git.repo.git.checkout("master")
-        gitee.git.repo.git.pull()
-    except git.exc.GitCommandError as e:
-        print(e)
-        print("Unable to switch to master. Perhaps you have an dirty sandbox.")
-        return 11
+    if not journal.done("parents"):
+        try:
+            if sparse:  # the merge commit is only needed as a ref
+                print(f"===> Fetching latest master...")
+                gitee.git.fetch()
+            else:
+                print(f"===> Updating to latest master...")
+                gitee.git.repo.git.checkout("master")
+                gitee.git.repo.git.pull()
+        except git.exc.GitCommandError as e:
+            print(e)
+            print("Unable to switch to master. Perhaps you have an dirty sandbox.")
+            return 11
 
-    try:
-        frm, to = gitee.git.get_head_parents()
-    except ValueError:
-        print("Something wrong with HEAD. It's not a merge commit.")
-        return 3
+        try:
+            if sparse:
+                parents = gitee.git.parents(gitee.git.refs()["refs/remotes/origin/master"])
+            else:
+                parents = gitee.git.get_head_parents()
+            if len(parents) != 2:
+                raise ValueError(parents)
+            journal.record("parents", parents)
+        except ValueError:
+            print("Something wrong with HEAD. It's not a merge commit.")
+            return 3
+    frm, to = journal.get("parents")
     # When release branch is cut early, we have to include trunk fixVersion in
     # cherry pick gargets. Like v1.100.0
     branches = jira.get_cherry_pick_branches(pr.issue_id)
@@ -658,74 +2229,132 @@ def merge(no, force, autocp):
     if tbr in gitee.git.remote_branches():
         branches.append(tbr)
     if not branches:
+        journal.remove()
         return 0
     print(f"===> Cherry picking to branches: {', '.join(branches)}...")
     try:
-        cherry_pick(gitee.git.repo.git, branches, frm, to, autocp)
-        jira.update_issue(pr.issue_id, f"Cherry-picked to {', '.join(branches)}", "")
+        if sparse:
+            cherry_pick_sparse(gitee.git, branches, frm, to, journal)
+        else:
+            cherry_pick(gitee.git, branches, frm, to, autocp, journal)
+        # an issue reopened by an earlier failed attempt is done now
+        trans = "done" if journal.done("reopened") else ""
+        # only a comment unless reopened before; don't wait for it then
+        jira.update_issue(
+            pr.issue_id, f"Cherry-picked to {', '.join(branches)}", trans, wait=bool(trans)
+        )
+        journal.remove()
     except git.exc.GitCommandError as e:
         print(e)
-        print("===> Something went wrong. Re-opending jira issue")
-        jira.update_issue(pr.issue_id, "Cherry picking failed", "reopen")
+        if not journal.done("reopened"):
+            print("===> Something went wrong. Re-opending jira issue")
+            jira.update_issue(pr.issue_id, "Cherry picking failed", "reopen")
+            journal.record("reopened")
+        print(f"===> Fix it and run: gira merge --continue {no}")
     return 0
 
 
-@main.command()
-@click.argument("branch")
-def lockbr(branch):
-    "Lock branch"
-    user = _conf["gitee"]["user"]
-    token = _conf["gitee"]["token"]
-    try:
-        gitee = Gitee(user, token)
-        gitee.lock_branch(branch)
-    except Exception as e:
-        print(e)
+def _repos(all_repos):
+    "Clones to work on: the one we are in, or all listed in gira.toml"
+    if not all_repos:
+        return ["."]
+    return [os.path.expanduser(p) for p in _conf["gitee"].get("repos", [])]
 
 
-def show_branches(full):
+def _on_repos(fn, all_repos, workers=8, lock=None):
+    """Runs fn(gitee) for each repo concurrently. Returns [(repo, result)]
+    where result is the exception raised by a failed repo. With lock, a
+    (worktree, common) pair of modes, fn runs holding the repo's RepoLock"""
     user = _conf["gitee"]["user"]
     token = _conf["gitee"]["token"]
-    try:
-        gitee = Gitee(user, token)
-        res = gitee.list_branch()
-        if full:
-            print(res.text)
-            return
-        for br in json.loads(res.text):
-            gitee.print_branch(br)
-    except Exception as e:
-        print(e)
 
+    def run(path):
+        try:
+            gitee = Gitee(user, token, path)
+        except Exception as e:
+            return path, e
+        try:
+            if lock:
+                with RepoLock(path, *lock):
+                    return gitee.name(), fn(gitee)
+            return gitee.name(), fn(gitee)
+        except Exception as e:
+            return gitee.name(), e
+
+    repos = _repos(all_repos)
+    if not repos:
+        print("No repos in gira.toml. Add them as gitee.repos.")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run, repos))
+
+
+def _print_errors(results):
+    "Prints failed repos and returns the rest"
+    good = []
+    for name, res in results:
+        if isinstance(res, Exception):
+            print(f"{name}: {res}")
+        else:
+            good.append((name, res))
+    return good
+
+
+def _apply(ops, workers=8):
+    "Runs [(description, fn)] concurrently and prints the ones that failed"
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(desc, pool.submit(fn)) for desc, fn in ops]
+    for desc, fut in futures:
+        if fut.exception():
+            print(f"{desc} failed: {fut.exception()}")
+
+
+def _protect(patterns, lock, all_repos, dry_run):
+    "Returns 1 if a pattern matches no branch, probably a typo"
+    def plan(gitee):
+        brs = gitee.list_branches()
+        match = [
+            br for br in brs
+            if any(fnmatch.fnmatchcase(br["name"], p) for p in patterns)
+        ]
+        unmatched = [
+            p for p in patterns if not any(fnmatch.fnmatchcase(br["name"], p) for br in brs)
+        ]
+        return gitee, [br["name"] for br in match if br["protected"] != lock], len(match), unmatched
+
+    verb = "lock" if lock else "unlock"
+    ops = []
+    ret = 0
+    for name, (gitee, brs, matched, unmatched) in _print_errors(_on_repos(plan, all_repos)):
+        for p in unmatched:
+            print(f"{name}: no branch matches {p}")
+            ret = 1
+        if matched:
+            print(f"{name}: {matched - len(brs)} matching branches are already {verb}ed")
+        for br in brs:
+            print(f"{name}: {verb} {br}")
+            fn = gitee.lock_branch if lock else gitee.unlock_branch
+            ops.append((f"{name}: {verb} {br}", lambda fn=fn, br=br: fn(br)))
+    if not dry_run:
+        _apply(ops)
+    return ret
 
-def show_team(full):
-    user = _conf["gitee"]["user"]
-    token = _conf["gitee"]["token"]
-    try:
-        gitee = Gitee(user, token)
-        res = gitee.list_member()
-        if full:
-            print(res.text)
-            return
-        for u in json.loads(res.text):
-            gitee.print_user(u)
-    except Exception as e:
-        print(e)
 
+@main.command()
+@click.option("--all-repos", is_flag=True, help="Do it for all repos in gira.toml")
+@click.option("--dry-run", is_flag=True, help="Only show what would be locked")
+@click.argument("patterns", nargs=-1, required=True)
+def lockbr(patterns, all_repos, dry_run):
+    "Lock branches. Takes glob patterns like 'release-*'"
+    sys.exit(_protect(patterns, True, all_repos, dry_run))
 
-def show_prs(full):
-    user = _conf["gitee"]["user"]
-    token = _conf["gitee"]["token"]
-    try:
-        gitee = Gitee(user, token)
-        res = gitee.list_prs()
-        if full:
-            print(res.text)
-            return
-        for pr in json.loads(res.text):
-            gitee.print_prs(pr)
-    except Exception as e:
-        print(e)
+
+@main.command()
+@click.option("--all-repos", is_flag=True, help="Do it for all repos in gira.toml")
+@click.option("--dry-run", is_flag=True, help="Only show what would be unlocked")
+@click.argument("patterns", nargs=-1, required=True)
+def unlockbr(patterns, all_repos, dry_run):
+    "Unlock branches. Takes glob patterns like 'release-*'"
+    sys.exit(_protect(patterns, False, all_repos, dry_run))
 
 
 @main.command()
@@ -734,42 +2363,121 @@ def show_prs(full):
     default=False,
     help="Display full JSON. what can be <branch, team, pr>",
 )
+@click.option("--all-repos", is_flag=True, help="Show stuff of all repos in gira.toml")
 @click.argument("what")
-def show(full, what):
+def show(full, what, all_repos):
     "Show stuff"
     if what == "branch" or what == "branches":
-        show_branches(full)
+        fetch, printer = lambda g: json.dumps(g.list_branches()), Gitee.print_branch
     elif what == "team":
-        show_team(full)
+        fetch, printer = lambda g: json.dumps(g.list_members()), Gitee.print_user
     elif what == "pr" or what =="prs":
-        show_prs(full)
+        fetch, printer = lambda g: g.list_prs().text, Gitee.print_prs
+    else:
+        return
+
+    results = _print_errors(
+        _on_repos(lambda gitee: (gitee, fetch(gitee)), all_repos)
+    )
+    if full:
+        if all_repos:
+            print(json.dumps({name: json.loads(text) for name, (_, text) in results}))
+        else:
+            for _, (_, text) in results:
+                print(text)
+        return
+    for name, (gitee, text) in results:
+        for item in json.loads(text):
+            if all_repos:
+                print(f"{name}: ", end="")
+            printer(gitee, item)
 
 
 @main.command()
+@click.option("--all-repos", is_flag=True, help="Do it for all repos in gira.toml")
 @click.argument("user")
 @click.argument("permission", default="push")
-def adduser(user, permission):
+def adduser(user, permission, all_repos):
     "Add gitee user"
-    me = _conf["gitee"]["user"]
-    token = _conf["gitee"]["token"]
-    try:
-        gitee = Gitee(me, token)
-        gitee.add_user(user, permission)
-    except Exception as e:
-        print(e)
+    _print_errors(_on_repos(lambda gitee: gitee.add_user(user, permission), all_repos))
 
 
 @main.command()
+@click.option("--all-repos", is_flag=True, help="Do it for all repos in gira.toml")
 @click.argument("user")
-def deluser(user):
+def deluser(user, all_repos):
     "Delete gitee user"
-    me = _conf["gitee"]["user"]
-    token = _conf["gitee"]["token"]
+    _print_errors(_on_repos(lambda gitee: gitee.del_user(user), all_repos))
+
+
+def _permission(member):
+    for perm in ("admin", "push", "pull"):
+        if member["permissions"].get(perm):
+            return perm
+    return ""
+
+
+def _team_plan(gitee, wanted):
+    "Returns [(method, user, permission)] that turn current members into wanted"
+    have = {m["login"]: _permission(m) for m in gitee.list_members()}
+    plan = []
+    for user, perm in sorted(wanted.items()):
+        if have.get(user) != perm:
+            plan.append(("add_user", user, perm))
+    for user in sorted(have):
+        if user not in wanted and user != gitee.user:  # never lock ourselves out
+            plan.append(("del_user", user, have[user]))
+    return plan
+
+
+@main.group()
+def team():
+    "Manage collaborators"
+    pass
+
+
+@team.command()
+@click.option("--dry-run", is_flag=True, help="Only print the plan")
+@click.option("--yes", is_flag=True, help="Don't ask before applying the plan")
+@click.option("--all-repos", is_flag=True, help="Sync all repos in gira.toml")
+@click.argument("file")
+def sync(file, dry_run, yes, all_repos):
+    """Make collaborators match FILE, a TOML file like:
+
+    \b
+    [users]
+    alice = "push"
+    bob = "admin"
+    """
     try:
-        gitee = Gitee(me, token)
-        gitee.del_user(user)
-    except Exception as e:
-        print(e)
+        with open(file) as f:
+            wanted = toml.loads(f.read())["users"]
+    except (IOError, KeyError, toml.TomlDecodeError) as e:
+        print(f"Invalid team file {file}: {e}")
+        return 1
+    bad = [u for u, p in wanted.items() if p not in Gitee.allowed_permissions]
+    if bad:
+        print(f"Invalid permission for: {', '.join(bad)}")
+        return 1
+
+    plans = _print_errors(
+        _on_repos(lambda gitee: (gitee, _team_plan(gitee, wanted)), all_repos)
+    )
+    ops = []
+    for name, (gitee, plan) in plans:
+        for method, user, perm in plan:
+            if method == "del_user":
+                desc, fn = f"{name}: remove {user} ({perm})", lambda g=gitee, u=user: g.del_user(u)
+            else:
+                desc, fn = f"{name}: set {user} ({perm})", lambda g=gitee, u=user, p=perm: g.add_user(u, p)
+            print(desc)
+            ops.append((desc, fn))
+    if not ops:
+        print("Nothing to do.")
+        return 0
+    if dry_run or not (yes or click.confirm("Apply?")):
+        return 0
+    _apply(ops)
 
 
 @main.command()
@@ -794,27 +2502,47 @@ def jira(pr_no):
     jira = MyJira(
         _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
     )
-    pr = PR(gitee.get_pr(pr_no))
+    pr = PR(Store(gitee.git).pr(pr_no) or gitee.get_pr(pr_no))
     jira.goto_issue(pr.issue_id)
 
 
 @main.command()
+@click.option(
+    "--sparse",
+    is_flag=True,
+    help="Check out only the files changed by the PR in a separate worktree",
+)
 @click.argument("no")
-def review(no):
+@_locked(lambda sparse, **_: RepoLock.SHARED if sparse else RepoLock.EXCLUSIVE)
+def review(no, sparse):
     user = _conf["gitee"]["user"]
     token = _conf["gitee"]["token"]
     try:
         gitee = Gitee(user, token)
-        pr = PR(gitee.get_pr(no))
+        store = Store(gitee.git)
+        pr = PR(store.pr(no) or gitee.get_pr(no))
         jira = MyJira(
             _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
         )
+        jira.warm(store)
     except GiteeError as e:
         print(f"Error: {e}", file=sys.stderr)
         return 1
 
     print(f"===> Reviewing PR for: {pr.issue_id} {jira.get_summary(pr.issue_id)}")
     gitee.goto_pull(no)
+    if sparse:
+        base = gitee.git.scratch_base()
+        base.fetch()
+        head, target = f"origin/{pr.issue_id}", f"origin/{pr.base['label']}"
+        path = os.path.join(_cache_dir(), "review", gitee.owner, gitee.repo, str(no))
+        if os.path.exists(path):  # left from an earlier review
+            shutil.rmtree(path)
+            base.repo.git.worktree("prune")
+        paths = base.changed_paths(f"{target}...{head}")
+        with Worktree(base, head, paths, path):
+            print(f"===> Files changed by PR {no} are in:\t{path}")
+        return 0
     gitee.git.repo.git.checkout("master")
     gitee.git.repo.git.pull()
     print(f"===> Switching to branch:\t{pr.issue_id}")
@@ -829,18 +2557,154 @@ def review(no):
 
 
 @main.command()
+@click.option("--all-repos", is_flag=True, help="Prefetch for all repos in gira.toml")
+def prefetch(all_repos):
+    "Keep open PRs, their issues and remote branches fresh locally. Run it from cron"
+    try:
+        jira = MyJira(
+            _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
+        )
+    except MyJiraError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    def run(gitee):
+        gitee.lane = Scheduler.BACKGROUND
+        return Store(gitee.git).refresh(gitee, jira)
+
+    # only git fetch and gira's own files, the working tree isn't touched
+    results = _on_repos(run, all_repos, lock=(None, RepoLock.EXCLUSIVE))
+    for name, (prs, issues) in _print_errors(results):
+        print(f"{name}: {len(prs)} PRs and {len(issues)} issues updated")
+
+
+@main.command("sync")
+def sync_mirror():
+    "Mirror PRs and their JIRA issues into .git/gira/mirror.db"
+    user = _conf["gitee"]["user"]
+    token = _conf["gitee"]["token"]
+    try:
+        gitee = Gitee(user, token)
+        jira = MyJira(
+            _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
+        )
+        prs, issues = Mirror(gitee.git).sync(gitee, jira)
+    except (GiteeError, MyJiraError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    print(f"{prs} PRs and {issues} issues updated")
+
+
+def _mirror():
+    "Mirror of the clone we are in, found from subdirectories too"
+    user = _conf["gitee"]["user"]
+    token = _conf["gitee"]["token"]
+    return Mirror(Gitee(user, token).git)
+
+
+@main.command()
+@click.argument("text")
+def search(text):
+    "Search titles of mirrored PRs and issues. Run gira sync first"
+    try:
+        found = _mirror().search(text)
+    except GiteeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    except sqlite3.OperationalError as e:
+        print(f"Invalid search: {e}")
+        return 1
+    for kind, ref, title, state in found:
+        if kind == "pr":
+            ref = f"!{ref}"
+        print(f"{ref:<12} {state:<10} {title}")
+
+
+@main.command()
+@click.option("--state", default=None, help="PR state: open, merged or closed")
+@click.option("--project", default=None, help="JIRA project of the PR's issue")
+@click.option("--fix-version", default=None, help="fixVersion glob, like 'v1.9.*'")
+def query(state, project, fix_version):
+    "List mirrored PRs by state, project and fixVersion. Run gira sync first"
+    try:
+        found = _mirror().query(state, project, fix_version)
+    except GiteeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    for no, st, issue, title, url, _, fvs in found:
+        fvs = ",".join((fvs or "").split("\n"))
+        print(f"!{no:<5} {st:<7} {fvs:<20} {title}")
+
+
+@main.command()
+@click.option("--interval", default=60, help="Seconds between polls")
+@click.option("--hook", default=None, help="Command run for every event, with the event JSON on stdin")
+@click.option("--metrics-port", type=int, default=None, help="Serve metrics on this port")
+@click.option("--all-repos", is_flag=True, help="Watch all repos in gira.toml")
+def watch(interval, hook, metrics_port, all_repos):
+    "Print PR and JIRA issue changes as JSON lines"
+    try:
+        jira = MyJira(
+            _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
+        )
+    except MyJiraError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    port = metrics_port or _conf.get("metrics", {}).get("port")
+    if port:
+        _metrics.serve(port)
+
+    lock = threading.Lock()
+
+    def emit(event, gitee, **data):
+        line = json.dumps(dict(data, event=event, repo=gitee.name(), time=time.time()))
+        with lock:
+            if hook:
+                subprocess.run(hook, shell=True, input=line.encode())
+            else:
+                print(line, flush=True)
+
+    watchers = _print_errors(_on_repos(lambda gitee: Watcher(gitee, jira, emit), all_repos))
+    try:
+        while True:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = [(name, pool.submit(w.poll)) for name, w in watchers]
+            for name, fut in results:
+                if fut.exception():
+                    print(f"{name}: {fut.exception()}", file=sys.stderr)
+            _metrics.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+@main.command()
+@click.option(
+    "--pool/--no-pool",
+    default=None,
+    help="Use a worktree from the pool and print its path. Default: pool.enabled",
+)
 @click.argument("no")
-def switch(no):
-    "Switch to PR branch"
+@_locked(lambda pool, **_: None if _use_pool(pool) else RepoLock.EXCLUSIVE)
+def switch(no, pool):
+    """Switch to PR branch. With --pool, print the path of its worktree
+    instead, e.g. cd $(gira switch --pool 17)"""
     user = _conf["gitee"]["user"]
     token = _conf["gitee"]["token"]
     try:
         gitee = Gitee(user, token)
-        pr = PR(gitee.get_pr(no))
+        pr = PR(Store(gitee.git).pr(no) or gitee.get_pr(no))
     except GiteeError as e:
         print(f"Error: {e}", file=sys.stderr)
         return 1
 
+    if _use_pool(pool):
+        try:
+            print(WorktreePool(gitee.git).get(pr.issue_id))
+        except GitCommandError as e:
+            print(e, file=sys.stderr)
+            return 2
+        return 0
     print(f"===> Switching to branch: {pr.issue_id}")
     gitee.git.repo.git.checkout("master")
     gitee.git.repo.git.pull()
@@ -849,9 +2713,18 @@ def switch(no):
 
 
 @main.command()
+@click.option(
+    "--pool/--no-pool",
+    default=None,
+    help="Use a worktree from the pool and print its path. Default: pool.enabled",
+)
 @click.argument("issue_no")
-def start(issue_no):
-    "Start progress for JIRA issue"
+@_locked(lambda pool, **_: None if _use_pool(pool) else RepoLock.EXCLUSIVE)
+def start(issue_no, pool):
+    """Start progress for JIRA issue. With --pool, only the path of its worktree
+    goes to stdout, e.g. cd $(gira start --pool CLOUD-1234)"""
+    pool = _use_pool(pool)
+    out = sys.stderr if pool else sys.stdout  # keep stdout for the path
     user = _conf["gitee"]["user"]
     token = _conf["gitee"]["token"]
     try:
@@ -875,41 +2748,53 @@ def start(issue_no):
             raise e
 
     if not issue_ready_to_start():
-        print("Issue has no fix versions or not assigned to someone. Aborting...")
+        print("Issue has no fix versions or not assigned to someone. Aborting...", file=out)
         return False
-    print("===> Updating JIRA issue status...")
+    print("===> Updating JIRA issue status...", file=out)
     jira.update_issue(issue_no, "Starting...", "in_progress")
 
-    print("===> Waiting for remote branch to be created...")
+    print("===> Waiting for remote branch to be created...", file=out)
     # wait for webhook to create remote branch
     try:
         branch_ready()
     except GiteeError as e:
-        print("Something went wrong with jira webhook. Aborting...")
-        print("Possible reasons includes:")
-        print("1. JIRA issue doesn't have a valid component.")
-        print("2. JIRA issue isn't assgined to.")
-        print("3. JIRA issue status isn't *In Progress*.")
-        print("4. JIRA issue is an Epic or has subtasks.")
-        print("5. 你的JIRA是中文的UI.")
-        print("6. You have invalid gitee token.")
+        print("Something went wrong with jira webhook. Aborting...", file=out)
+        print("Possible reasons includes:", file=out)
+        print("1. JIRA issue doesn't have a valid component.", file=out)
+        print("2. JIRA issue isn't assgined to.", file=out)
+        print("3. JIRA issue status isn't *In Progress*.", file=out)
+        print("4. JIRA issue is an Epic or has subtasks.", file=out)
+        print("5. 你的JIRA是中文的UI.", file=out)
+        print("6. You have invalid gitee token.", file=out)
 
-        print(e)
+        print(e, file=out)
 
         return
 
+    if pool:
+        print("===> Creating worktree...", file=out)
+        try:
+            path = WorktreePool(gitee.git).get(issue_no)
+        except GitCommandError as e:
+            print(e, file=sys.stderr)
+            return 2
+        print("\n\nYou're all set. 请开始你的表演．．．", file=out)
+        print(path)
+        return
     # checkout to new branch
     gitee.git.repo.git.checkout("master")
     gitee.git.repo.git.pull()
-    print("===> Switching to PR branch...")
+    print("===> Switching to PR branch...", file=out)
     gitee.git.repo.git.checkout(issue_no)
-    print("\n\nYou're all set. 请开始你的表演．．．")
+    print("\n\nYou're all set. 请开始你的表演．．．", file=out)
 
 
 @main.command()
 @click.argument("issue_no", nargs=-1)
+@_locked(RepoLock.EXCLUSIVE)
 def finish(issue_no):
-    "Finish JIRA issue"
+    """Finish JIRA issues by creating PRs. Without ISSUE_NO, the current
+    branch is the issue. With several, each is pushed from its own branch."""
     user = _conf["gitee"]["user"]
     token = _conf["gitee"]["token"]
     try:
@@ -925,37 +2810,65 @@ def finish(issue_no):
         if gitee.git.repo.is_dirty():
             print("Working directory seems to be dirty. Refusing to continue.")
             return 2
-        br = gitee.git.current_branch()
-        if br == "master":
-            print("You have to be on your PR branch to create a PR.")
-            return 3
-        print(f"===> Pushing to remote repo...")
-        gitee.git.repo.git.push()
-
-        if not issue_no:
-            issue_no = gitee.git.current_branch()
+        if len(issue_no) > 1:
+            # several issues: each on its own branch named after it
+            todo = [(i, i) for i in issue_no]
+            print(f"===> Pushing to remote repo...")
+            gitee.git.repo.git.push("origin", *issue_no)
         else:
-            issue_no = issue_no[0]
-
-        target_br = jira.get_target_branch(issue_no)
-        if gitee.git.needs_rebase(br, target_br):
-            print("!!! It looks like your branch needs rebasing.")
-            return 4
+            br = gitee.git.current_branch()
+            if br == "master":
+                print("You have to be on your PR branch to create a PR.")
+                return 3
+            todo = [(issue_no[0] if issue_no else br, br)]
+            print(f"===> Pushing to remote repo...")
+            gitee.git.repo.git.push()
+
+        jira.preload([i for i, _ in todo])
+        targets = {}
+        for i, br in todo:
+            targets[i] = jira.get_target_branch(i)
+            if gitee.git.needs_rebase(br, targets[i]):
+                print(f"!!! It looks like branch {br} needs rebasing.")
+                return 4
+    except git.exc.GitCommandError as e:
+        print(e)
+        return 5
 
-        print(f"===> Creating PR for {issue_no}...")
-        title = f"{issue_no} {jira.get_summary(issue_no)}"  # causes exception
+    def create(i, br):
+        print(f"===> Creating PR for {i}...")
+        title = f"{i} {jira.get_summary(i)}"  # causes exception
         body = "%s\nFix Version/s: %s" % (
-            jira.get_issue_url(issue_no), ",".join(jira.get_fix_versions(issue_no)))
-        res = gitee.create_pr(title, br, body, target_br)  # TODO: automatically fill in assignee
-        jira.finish_issue(issue_no, f'PR created: {res.json()["html_url"]}')
+            jira.get_issue_url(i), ",".join(jira.get_fix_versions(i)))
+        res = gitee.create_pr(title, br, body, targets[i])  # TODO: automatically fill in assignee
+        jira.finish_issue(i, f'PR created: {res.json()["html_url"]}')
+        return res.json()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [(i, pool.submit(create, i, br)) for i, br in todo]
+    created = []
+    for i, fut in futures:
+        e = fut.exception()
+        if isinstance(e, GiteeError):
+            print(f"Failed to create PR for {i}.")
+            print(e)
+            print(e.args[0].text)
+        elif e:
+            print(f"Failed to finish {i}: {e}")
+        else:
+            created.append((i, fut.result()))
+    if not created:
+        return 6
+    if len(todo) == 1:
         print("===> Navigating to PR. 请手动分配reviewer和tester。并按语雀项目规定配置PR。")
         print("同时请记得将JIRA issue assign给测试人员。")
-        gitee.goto_pull(str(res.json()["number"]))
-    except GiteeError as e:
-        print("Failed to create PR.")
-        print(e)
-        print(e.args[0].text)
-    # TODO: catch git and jira exceptions
+        gitee.goto_pull(str(created[0][1]["number"]))
+    else:
+        for i, pr in created:
+            print(f"{i}: {pr['html_url']}")
+        print("===> 请手动分配reviewer和tester。并按语雀项目规定配置PR。")
+        print("同时请记得将JIRA issue assign给测试人员。")
+    return 0 if len(created) == len(todo) else 6
 
 
 @main.command()
@@ -1014,6 +2927,140 @@ def exclude(issue_no, version):
         return 1
 
 
+@main.command()
+@click.option("--from", "frm", default=None, help="Start of commit range. Defaults to the previous tag.")
+@click.option("--to", default=None, help="End of commit range. Defaults to the version tag or release branch.")
+@click.argument("version")
+@_locked(RepoLock.SHARED)
+def release_notes(version, frm, to):
+    "Release notes of a version from git history and JIRA"
+    user = _conf["gitee"]["user"]
+    token = _conf["gitee"]["token"]
+    try:
+        gitee = Gitee(user, token)
+        jira = MyJira(
+            _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
+        )
+    except GiteeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if to is None:
+        rv = ReleaseVersion(version)
+        if f"refs/tags/{version}" in gitee.git.refs():
+            to = version
+        elif rv.is_semver and _release_branch(rv) in gitee.git.remote_branches():
+            to = "origin/" + _release_branch(rv)
+        else:
+            to = "origin/master"
+    try:
+        if frm is None:
+            frm = gitee.git.last_tag(to)
+        commits = gitee.git.issue_commits(f"{frm}..{to}")
+    except GitCommandError as e:
+        print(e)
+        print("Unable to find commit range. Try --from and --to.")
+        return 2
+
+    if _projects():
+        commits = {k: v for k, v in commits.items() if k.partition("-")[0] in _projects()}
+    issues = jira.search(commits.keys())
+    planned = jira.issues_in_version(version)
+
+    print(f"===> Release notes for {version} ({frm}..{to})")
+    for key in sorted(issues):
+        isu = issues[key]
+        print(f"* {key} {isu.fields.summary} [{isu.fields.issuetype.name}]")
+
+    print(f"\n===> Mismatches between JIRA and {frm}..{to}")
+    for key in sorted(commits):
+        if key not in issues:
+            print(f"? {key} not found in JIRA, {len(commits[key])} commit(s)")
+            continue
+        fvs = [fv.name for fv in issues[key].fields.fixVersions]
+        if version not in fvs:
+            print(f"! {key} is in range but fixVersions are: {', '.join(fvs) or 'none'}")
+    for key in sorted(planned):
+        if key not in commits:
+            print(f"! {key} has fixVersion {version} but no commit in range")
+
+
+@main.command()
+@click.option(
+    "--update/--no-update",
+    default=True,
+    help="Index new commits on remote branches before answering",
+)
+@click.argument("issue")
+@_locked(RepoLock.SHARED)
+def where(issue, update):
+    "Show commits and remote branches of a JIRA issue"
+    user = _conf["gitee"]["user"]
+    token = _conf["gitee"]["token"]
+    try:
+        gitee = Gitee(user, token)
+    except GiteeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    index = IssueIndex(gitee.git)
+    if update:
+        index.update()
+    commits, branches = index.lookup(issue)
+    if not commits:
+        print(f"{issue} not found on any remote branch.")
+        return 0
+    print(f"commits: {', '.join(c[:10] for c in commits)}")
+    print(f"branches: {', '.join(branches)}")
+
+
+@main.command()
+@click.option("--fetch/--no-fetch", default=True, help="Fetch from remote repo first")
+@click.option("--all-repos", is_flag=True, help="Audit all repos in gira.toml")
+@click.argument(
+    "jql", default="status in (Resolved, Closed) AND fixVersion in unreleasedVersions()"
+)
+def audit(jql, fetch, all_repos):
+    "Check that issues are cherry picked to all their fixVersion branches"
+    try:
+        jira = MyJira(
+            _conf["jira"]["url"], _conf["jira"]["user"], _conf["jira"]["passwd"]
+        )
+    except MyJiraError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    issues = jira.query(jql, "summary,fixVersions")
+    print(f"===> Auditing {len(issues)} issues...")
+
+    def run(gitee):
+        if fetch:
+            gitee.git.fetch()
+        return gitee.git.remote_heads(), _audit(gitee.git, jira, issues)
+
+    common = RepoLock.EXCLUSIVE if fetch else RepoLock.SHARED
+    results = _print_errors(_on_repos(run, all_repos, lock=(RepoLock.SHARED, common)))
+    bad = 0
+    for key in sorted(issues):
+        found = missed = False
+        for name, (heads, res) in results:
+            commits, missing, partial = res[key]
+            found = found or bool(commits)
+            if not commits or not (missing or partial):
+                continue
+            missed = True
+            where = f" {name}" if all_repos else ""
+            if missing:
+                brs = [br if br in heads else f"{br} (no such branch)" for br in missing]
+                print(f"! {key} missing on{where}: {', '.join(brs)}")
+            if partial:
+                print(f"~ {key} partly picked on{where}: {', '.join(partial)}")
+        if not found:
+            print(f"? {key} has no commit on any remote branch")
+        bad += missed
+    print(f"===> {bad} of {len(issues)} issues are not fully cherry picked")
+
+
 @main.command()
 @click.argument("what")
 def runtests(what):
@@ -1027,6 +3074,16 @@ def runtests(what):
         _test_jira()
         _test_release()
         _test_gitee()
+        _test_team()
+        _test_prefetch()
+        _test_metrics()
+        _test_scheduler()
+        _test_issue_ids()
+        _test_index()
+        _test_audit()
+        _test_journal()
+        _test_watch()
+        _test_pick()
 
 
 @main.command()
@@ -1105,6 +3162,9 @@ def _test_jira():
     fvs = ["v1.9.1"]
     if jra._target_br(fvs) != "release-1.9":
         print("XXX: expected target branch release-1.9")
+    fvs = ["v1.6.7-cmft"]
+    if jra._target_br(fvs) != "release-1.6-cmft":
+        print("XXX: expected target branch release-1.6-cmft")
 
 
 def _test_git():
@@ -1171,11 +3231,302 @@ def _test_release():
         else:
             print(f"NOK {rel}")
             print(f"{r.major}.{r.minor}.{r.fix}-{r.project}")
+
+
+def _test_watch():
+    print("===> Testing watch events...")
+    users = lambda *names: [{"login": n} for n in names]
+    old = {"state": "open", "title": "CLOUD-1 x", "assignees": [], "testers": []}
+    new = dict(old, assignees=users("bob"), testers=users("eve"))
+    events = [e for e, _ in _pr_events(old, new)]
+    if events != ["reviewer_assigned", "tester_assigned", "ready"]:
+        print(f"XXX: wrong PR events {events}")
+    events = [e for e, _ in _pr_events(new, dict(new, state="merged"))]
+    if events != ["pr_state"]:
+        print(f"XXX: wrong PR events {events}")
+    if [e for e, _ in _pr_events(None, old)] != ["new_pr"]:
+        print("XXX: expected new_pr")
+    if _pr_events(None, dict(old, state="merged")):
+        print("XXX: a merged PR not seen before isn't new")
+
+    class FakeGitee():
+        lane = etags = None
+        prs = []
+
+        def get_all(self, urls, params=None):
+            return [pr for pr in self.prs if pr["state"] == "open"]
+
+        def list_prs_since(self, since):
+            return [pr for pr in self.prs if pr["updated_at"] > since]
+
+    class FakeJira():
+        def search(self, issue_ids, fields, where="", expand=None):
+            return {}
+
+        def search_updated_since(self, issue_ids, since, fields, expand=None):
+            return {}
+
+    gitee, events = FakeGitee(), []
+    watcher = Watcher(gitee, FakeJira(), lambda e, _, **data: events.append((e, data["pr"])))
+    watcher.poll()  # no PR at all yet
+    gitee.prs = [dict(old, number=1, updated_at="2024-01-01")]
+    watcher.poll()
+    gitee.prs.append(dict(old, number=7, state="merged", updated_at="2024-01-02"))
+    watcher.poll()
+    if events != [("new_pr", 1)]:
+        print(f"XXX: wrong watch events {events}")
+
+
+def _test_scheduler():
+    print("===> Testing scheduler...")
+    sched = Scheduler(1e-6, 2)  # no token comes back while testing
+    sched.tokens = 0
+    threads = {}
+    for lane in (Scheduler.BACKGROUND, Scheduler.INTERACTIVE):
+        threads[lane] = threading.Thread(target=sched.acquire, args=(lane,))
+        threads[lane].start()
+        with sched.cond:  # background waits first
+            while not sched.waiting[lane]:
+                sched.cond.wait(0.01)
+    for lane in (Scheduler.INTERACTIVE, Scheduler.BACKGROUND):
+        with sched.cond:
+            sched.tokens += 1
+            sched.cond.notify_all()
+        threads[lane].join(5)
+        if threads[lane].is_alive():
+            print("XXX: interactive requests should go first")
+            with sched.cond:
+                sched.tokens += 1
+                sched.cond.notify_all()
+            threads[lane].join()
+
+
+def _test_issue_ids():
+    print("===> Testing issue IDs in commit messages...")
+    msg = "!17 CLOUD-1234 fix\n\nCLOUD-99 also\n- not an issue\nX- neither"
+    if _issue_ids(msg) != ["CLOUD-1234", "CLOUD-99"]:
+        print(f"XXX: wrong issue IDs {_issue_ids(msg)}")
+
+
+def _scratch_repo():
+    """Clone of an empty origin in a temp dir, on master with one commit.
+    Returns the temp dir, a function running git in the clone and one committing a file"""
+    tmp = tempfile.mkdtemp(prefix="gira-test-")
+    clone = os.path.join(tmp, "clone")
+    run = lambda *args: subprocess.run(["git", *args], cwd=clone, check=True, capture_output=True)
+
+    def commit(name, msg):
+        with open(os.path.join(clone, name), "w") as f:
+            f.write(name)
+        run("add", name)
+        run("commit", "-m", msg)
+
+    subprocess.run(["git", "init", "-q", "--bare", os.path.join(tmp, "origin")], check=True)
+    subprocess.run(["git", "clone", "-q", "origin", "clone"], cwd=tmp, check=True, capture_output=True)
+    run("config", "user.name", "gira")  # for commits made by gira too
+    run("config", "user.email", "gira@test")
+    run("checkout", "-b", "master")
+    run("commit", "--allow-empty", "-m", "init")
+    return tmp, run, commit
+
+
+def _test_index():
+    print("===> Testing issue index...")
+    tmp, run, commit = _scratch_repo()
+    index = lambda: IssueIndex(Git(os.path.join(tmp, "clone")))
+    try:
+        commit("a", "CLOUD-1 a")
+        run("branch", "release-1")
+        commit("b", "CLOUD-2 b")
+        run("push", "origin", "master")
+        run("fetch", "origin")
+        index().update()
+        run("checkout", "-b", "CLOUD-3", "release-1")
+        commit("c", "CLOUD-3 c")
+        run("push", "origin", "release-1", "CLOUD-3")
+        run("fetch", "origin")
+        idx = index()
+        idx.update()  # release-1 is seeded from master
+        for issue, brs in (("CLOUD-1", ["master", "release-1"]), ("CLOUD-2", ["master"]), ("CLOUD-3", [])):
+            if idx.lookup(issue)[1] != brs:
+                print(f"XXX: {issue} should be on {brs}, not {idx.lookup(issue)[1]}")
+        run("checkout", "release-1")
+        commit("d", "CLOUD-4 d")
+        run("push", "origin", "release-1")
+        run("fetch", "origin")
+        idx = index()
+        idx.update()
+        if idx.lookup("CLOUD-4")[1] != ["release-1"] or idx.lookup("CLOUD-1")[1] != ["master", "release-1"]:
+            print("XXX: wrong branches after release-1 moved")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _test_audit():
+    print("===> Testing audit...")
+    tmp, run, commit = _scratch_repo()
+
+    class FakeIssue():
+        def __init__(self, *fvs):
+            self.fields = self
+            self.fixVersions = [type("Version", (), {"name": fv}) for fv in fvs]
+
+    issues = {"CLOUD-1": FakeIssue("v1.0.1"), "CLOUD-2": FakeIssue("v1.0.1")}
+    audit = lambda: _audit(Git(os.path.join(tmp, "clone")), MyJira.__new__(MyJira), issues)
+    try:
+        run("branch", "release-1.0")
+        commit("a", "CLOUD-1 a")
+        commit("b", "CLOUD-1 b")
+        commit("c", "CLOUD-2 c")
+        run("checkout", "release-1.0")
+        run("cherry-pick", "-x", "master~2")
+        run("push", "origin", "master", "release-1.0")
+        run("fetch", "origin")
+        got = {k: v[1:] for k, v in audit().items()}
+        if got != {"CLOUD-1": ([], ["release-1.0"]), "CLOUD-2": (["release-1.0"], [])}:
+            print(f"XXX: CLOUD-1 should be partly picked, CLOUD-2 missing: {got}")
+        run("cherry-pick", "-x", "master~1")
+        run("push", "origin", "release-1.0")
+        run("fetch", "origin")
+        if audit()["CLOUD-1"][1:] != ([], []):
+            print("XXX: CLOUD-1 is fully picked now")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _test_journal():
+    print("===> Testing merge journal...")
+    tmp, run, commit = _scratch_repo()
+    try:
+        run("branch", "release-1")
+        run("branch", "release-2")
+        run("checkout", "-b", "CLOUD-1")
+        commit("a", "CLOUD-1 a")
+        run("checkout", "master")
+        run("merge", "--no-ff", "-m", "!1 CLOUD-1 fix", "CLOUD-1")
+        run("push", "-u", "origin", "master", "release-1", "release-2")
+        local = Git(os.path.join(tmp, "clone"))
+        journal = Journal(local, 1)
+        journal.record("merged")
+        journal.record("parents", local.parents("master"))
+        journal.record("picked:release-1")  # e.g. before a conflict on release-2
+        journal = Journal(local, 1)  # merge --continue
+        if not journal.load() or not journal.done("merged") or journal.done("resolved"):
+            print("XXX: wrong steps loaded from journal")
+        frm, to = journal.get("parents")
+        before = dict(local.remote_heads())
+        cherry_pick_real(local, ["release-1", "release-2"], frm, to, journal)
+        after = Git(os.path.join(tmp, "clone")).remote_heads()
+        if after["release-1"] != before["release-1"] or after["release-2"] == before["release-2"]:
+            print("XXX: only release-2 should be picked")
+        if not journal.done("picked:release-2"):
+            print("XXX: release-2 should be recorded")
+        journal.remove()
+        if journal.exists():
+            print("XXX: journal should be removed")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _test_metrics():
+    print("===> Testing metrics...")
+    m = Metrics()
+    m.inc("gira_x_total", branch="r")
+    m.inc("gira_x_total", branch="r")
+    m.observe("gira_d_seconds", 0.3)
+    text = Metrics.render(m.types, m.values)
+    for line in ('gira_x_total{branch="r"} 2', 'gira_d_seconds_bucket{le="0.25"} 0',
+                 'gira_d_seconds_bucket{le="0.5"} 1', "gira_d_seconds_count{} 1"):
+        if line not in text.splitlines():
+            print(f"XXX: metrics have no {line}")
+
+
+def _test_prefetch():
+    print("===> Testing prefetched issues...")
+    if _pr_issue_key({"title": "- fix typo"}) is not None:
+        print("XXX: '-' is not an issue key")
+
+    class FakeStore():
+        issues = {"CLOUD-1": {"fields": {"updated": "1"}}}
+
+        def fresh(self):
+            return True
+
+        def save(self):
+            pass
+
+    class FakeClient():
+        updated = "1"
+
+        def issue(self, issue_id, fields=None):
+            return type("Issue", (), {"fields": type("Fields", (), {"updated": self.updated})})
+
+    store, edits = FakeStore(), []
+    jira = MyJira.__new__(MyJira)
+    jira.jira, jira._issues = FakeClient(), {}
+    jira._edit = lambda *args: edits.append(args)
+    jira.warm(store)
+    jira._send("CLOUD-1", {"comments": ["a"], "transition": None, "fields": {}})
+    jira.warm(store)
+    jira.jira.updated = "2"
+    try:
+        jira._send("CLOUD-1", {"comments": ["b"], "transition": None, "fields": {}})
+        print("XXX: changed issue should not be written")
+    except MyJiraError:
+        pass
+    if len(edits) != 1 or "CLOUD-1" in store.issues:
+        print("XXX: only the unchanged issue should be written")
+
+
+def _test_team():
+    print("===> Testing team sync...")
+    member = lambda login, **perms: {"login": login, "permissions": perms}
+    if _permission(member("a", pull=True, push=True)) != "push":
+        print("XXX: expected push permission")
+
+    class FakeGitee():
+        user = "me"
+
+        def list_members(self):
+            return [member("me", admin=True), member("bob", pull=True), member("old", push=True)]
+
+    plan = _team_plan(FakeGitee(), {"bob": "push", "eve": "pull"})
+    if plan != [("add_user", "bob", "push"), ("add_user", "eve", "pull"), ("del_user", "old", "push")]:
+        print(f"XXX: wrong team plan {plan}")
+
+
+def _test_pick():
+    print("===> Testing cherry pick...")
+    tmp, run, commit = _scratch_repo()
+    try:
+        run("branch", "release-1")
+        run("checkout", "-b", "CLOUD-1")
+        for name in ("a", "b"):
+            commit(name, f"CLOUD-1 {name}")
+        run("checkout", "master")
+        run("merge", "--no-ff", "-m", "!1 CLOUD-1 fix", "CLOUD-1")
+        run("checkout", "release-1")
+        run("cherry-pick", "CLOUD-1~1")
+        run("commit", "--amend", "-m", "reworded pick")
+        run("push", "origin", "master", "release-1")
+        run("fetch", "origin")
+        local = Git(os.path.join(tmp, "clone"))
+        frm, to = local.parents("master")
+        plan = _pick_plan(local, frm, to)
+        left = _unpicked(local, plan, to, "release-1")
+        if left != [plan[0][1]]:
+            print("XXX: only the commit not picked yet should be left")
+        run("cherry-pick", left[0])
+        run("push", "origin", "release-1")
+        if _unpicked(local, plan, to, "release-1"):
+            print("XXX: release-1 has everything now")
+    finally:
+        shutil.rmtree(tmp)
 # }}}
 
 
 if __name__ == "__main__":
-    print(f"gira {_version}\n")
+    print(f"gira {_version}\n", file=sys.stderr)  # keep stdout for output
     load_conf(
         os.path.join(os.environ["HOME"], "gira.toml"),
         os.path.join(os.environ["HOME"], ".config/gira.toml"),